@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Documents/sec of serializing documents for indexing: the previous
+isinstance chain with per call imports and strftime against the type
+dispatch Encoder.
+
+    python benchmarks/encoder.py [documents]
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime, date
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from django.conf import settings
+
+settings.configure(INSTALLED_APPS=[], DATABASES={})
+
+from json import JSONEncoder
+
+from elasticsearch_engine.serializer import Encoder
+
+
+class PreviousEncoder(JSONEncoder):
+    """
+    Encoder.default before the dispatch table, without its broken iterable
+    branch and with a Decimal branch so both encoders accept the documents.
+    """
+
+    def default(self, value):
+        from django.db.models import Model
+        from elasticsearch_engine.fields import EmbeddedModel
+
+        if isinstance(value, datetime):
+            return value.strftime("%Y-%m-%dT%H:%M:%S")
+        elif isinstance(value, date):
+            dt = datetime(value.year, value.month, value.day, 0, 0, 0)
+            return dt.strftime("%Y-%m-%dT%H:%M:%S")
+        elif isinstance(value, (str, unicode)):
+            pass
+        elif isinstance(value, Decimal):
+            value = float(value)
+        elif isinstance(value, (Model, EmbeddedModel)):
+            pass
+        return value
+
+
+def make_documents(count):
+    return [{"name": u"event %d" % i, "count": i, "price": Decimal("%d.25" % i),
+             "created": datetime(2014, 1, 1, 12, 30, i % 60), "day": date(2014, 1, 1 + i % 28),
+             "history": [datetime(2013, 12, 1 + j, 8) for j in range(5)]}
+            for i in xrange(count)]
+
+
+def run(label, encoder, documents):
+    start = time.time()
+    for doc in documents:
+        json.dumps(doc, cls=encoder)
+    elapsed = time.time() - start
+    print "%-10s %8d docs  %7.3fs  %10.0f docs/sec" % (label, len(documents), elapsed, len(documents) / elapsed)
+    return len(documents) / elapsed
+
+
+if __name__ == "__main__":
+    documents = make_documents(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
+    before = run("previous", PreviousEncoder, documents)
+    after = run("dispatch", Encoder, documents)
+    print "speedup    %.1fx" % (after / before)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Rows/sec of building model instances from decoded ``_source`` documents:
+the previous ``Model(**dict_keys_to_str(doc))`` path against the
+precomputed hydrator used by ``QuerySet.__iter__``.
+
+    python benchmarks/hydration.py [rows]
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from django.conf import settings
+
+settings.configure(INSTALLED_APPS=[], DATABASES={})
+
+from django.db import models
+
+from elasticsearch_engine.utils import dict_keys_to_str, get_hydrator
+
+
+class Event(models.Model):
+    name = models.CharField(max_length=100)
+    kind = models.CharField(max_length=20)
+    body = models.TextField()
+    count = models.IntegerField()
+    score = models.FloatField()
+    active = models.BooleanField(default=True)
+    created = models.DateTimeField()
+
+    class Meta:
+        app_label = 'benchmarks'
+
+
+def make_documents(rows):
+    return [{u'_id': u'%d' % i, u'name': u'event %d' % i, u'kind': u'click', u'body': u'x' * 200,
+             u'count': i, u'score': i / 3.0, u'active': bool(i % 2), u'created': datetime(2014, 1, 1)}
+            for i in xrange(rows)]
+
+
+def constructor(doc):
+    data = dict_keys_to_str(doc)
+    return Event(**data)
+
+
+def run(label, build, rows):
+    documents = make_documents(rows)
+    start = time.time()
+    for doc in documents:
+        build(doc)
+    elapsed = time.time() - start
+    print "%-12s %8d rows  %7.3fs  %10.0f rows/sec" % (label, rows, elapsed, rows / elapsed)
+    return rows / elapsed
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    before = run("__init__", constructor, rows)
+    after = run("hydrator", get_hydrator(Event), rows)
+    print "speedup      %.1fx" % (after / before)
@@ -1 +1,54 @@
 __author__ = 'theofilis'
+
+# Distinct values up to this many are answered by a single terms aggregation
+DISTINCT_TERMS_SIZE = 1000
+
+# Buckets requested per page when walking a composite aggregation
+COMPOSITE_PAGE_SIZE = 1000
+
+
+def distinct_values(es, indices, doc_types, query, field, terms_size=DISTINCT_TERMS_SIZE,
+                    page_size=COMPOSITE_PAGE_SIZE):
+    """
+    Yield the distinct values of ``field`` among the documents matching ``query``.
+
+    A single terms aggregation answers small cardinalities. When it reports
+    values it could not fit, the values are paged with a composite
+    aggregation instead, so no documents are ever loaded.
+    """
+    body = {
+        "size": 0,
+        "query": query,
+        "aggs": {"distinct": {"terms": {"field": field, "size": terms_size, "order": {"_key": "asc"}}}},
+    }
+    result = es.search_raw(body, indices=indices, doc_types=doc_types)
+    agg = result["aggregations"]["distinct"]
+    if not agg.get("sum_other_doc_count"):
+        for bucket in agg["buckets"]:
+            yield bucket["key"]
+        return
+
+    for key in composite_keys(es, indices, doc_types, query, [field], page_size=page_size):
+        yield key[field]
+
+
+def composite_keys(es, indices, doc_types, query, fields, page_size=COMPOSITE_PAGE_SIZE):
+    """
+    Yield every distinct combination of ``fields`` as a dict, one composite
+    aggregation page at a time.
+    """
+    sources = [{field: {"terms": {"field": field}}} for field in fields]
+    after = None
+    while True:
+        composite = {"size": page_size, "sources": sources}
+        if after is not None:
+            composite["after"] = after
+        body = {"size": 0, "query": query, "aggs": {"distinct": {"composite": composite}}}
+        result = es.search_raw(body, indices=indices, doc_types=doc_types)
+        agg = result["aggregations"]["distinct"]
+        for bucket in agg["buckets"]:
+            yield bucket["key"]
+
+        after = agg.get("after_key")
+        if after is None or len(agg["buckets"]) < page_size:
+            return
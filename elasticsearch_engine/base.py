@@ -1,8 +1,23 @@
+import httplib
+import json
+import logging
+import socket
+import sys
+import threading
+import urllib
+from contextlib import contextmanager
+
 from django.core.exceptions import ImproperlyConfigured
 
+from .bulk import WriteBuffer, bulk_write
 from .creation import DatabaseCreation
+from .partition import list_partitions, partitioning
+from .tenancy import all_tenants, current_tenant, tenant_index
 from .serializer import Decoder, Encoder
+from .writebehind import get_indexer
 from pyes import ES
+from pyes.connection_http import POOL_MANAGER
+from pyes.exceptions import ElasticSearchException
 
 from djangotoolbox.db.base import NonrelDatabaseFeatures, \
     NonrelDatabaseWrapper, NonrelDatabaseClient, \
@@ -10,6 +25,14 @@ from djangotoolbox.db.base import NonrelDatabaseFeatures, \
 
 from djangotoolbox.db.base import NonrelDatabaseOperations
 
+logger = logging.getLogger(__name__)
+
+# How long bulk_load waits for the cluster to be green again
+BULK_LOAD_HEALTH_TIMEOUT = '60s'
+
+# elasticsearch answers a cluster health request that timed out with 408
+REQUEST_TIMEOUT = 408
+
 
 class DatabaseOperations(NonrelDatabaseOperations):
     def no_limit_value(self):
@@ -39,8 +62,10 @@ class DatabaseOperations(NonrelDatabaseOperations):
     compiler_module = __name__.rsplit('.', 1)[0] + '.compiler'
 
     def sql_flush(self, style, tables, sequence_list):
-        for table in tables:
-            self.connection.db_connection.delete_mapping(self.connection.db_name, table)
+        # flush empties the whole database, every tenant's documents included
+        with all_tenants():
+            for table in tables:
+                self.connection.db_connection.delete_mapping(self.connection.db_name, table)
         return []
 
     def check_aggregate_support(self, aggregate):
@@ -109,12 +134,44 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
         self.validation = DatabaseValidation(self)
         self.introspection = DatabaseIntrospection(self)
         self._is_connected = False
+        self._write_buffer = None
+        # Parse search responses while they are received, one hit at a time,
+        # over connections kept alive per thread
+        self._stream_connections = threading.local()
+        self.stream_results = self.settings_dict.get('OPTIONS', {}).get('STREAM_RESULTS', False)
 
     @property
     def db_connection(self):
         self._ensure_is_connected()
         return self._db_connection
 
+    @property
+    def db_name(self):
+        """
+        The index documents are read from and written to: NAME, or with
+        the TENANCY option the index or alias of the current tenant. A
+        multi-tenant database raises TenantRequired outside any tenant,
+        unless inside tenancy.all_tenants().
+        """
+        self._ensure_is_connected()
+        tenant = current_tenant(self)
+        if tenant is None:
+            return self._db_name
+        return tenant_index(self, self._db_connection, self._db_name, tenant)
+
+    @db_name.setter
+    def db_name(self, name):
+        self._db_name = name
+
+    def reconnect(self):
+        """
+        Drop the client so the next request opens new connections. Forked
+        processes call it so they do not share the sockets of their parent.
+        """
+        self._is_connected = False
+        self._stream_connections = threading.local()
+        POOL_MANAGER.clear()
+
     def _ensure_is_connected(self):
         if not self._is_connected:
             try:
@@ -122,19 +179,243 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
             except ValueError:
                 raise ImproperlyConfigured("PORT must be an integer")
 
-            self.db_name = self.settings_dict['NAME']
+            self._db_name = self.settings_dict['NAME']
 
             self._connection = ES("%s:%s" % (self.settings_dict['HOST'], port),
                                   decoder=Decoder,
                                   encoder=Encoder,
                                   autorefresh=True,
-                                  default_indices=[self.db_name])
+                                  default_indices=[self._db_name])
 
             self._db_connection = self._connection
             # auto index creation: check if to remove
             try:
-                self._connection.create_index(self.db_name)
+                self._connection.create_index(self._db_name)
             except:
                 pass
             # We're done!
-            self._is_connected = True
\ No newline at end of file
+            self._is_connected = True
+
+    def write(self, action):
+        """
+        Send an index, update or delete action built by bulk.py. Inside
+        write_buffer() it is queued for the next _bulk batch instead, and
+        with the WRITE_BEHIND option it is left to write_behind's workers.
+        """
+        if self._write_buffer is not None:
+            self._write_buffer.add(action)
+        elif self.write_behind is not None:
+            self.write_behind.put(action)
+        else:
+            bulk_write(self.db_connection, [action])
+
+    def flush_write_buffer(self):
+        """
+        Send the writes write_buffer() holds, so searches, counts and
+        deletes by query see them.
+        """
+        if self._write_buffer is not None:
+            self._write_buffer.flush()
+
+    @property
+    def write_behind(self):
+        """The WriteBehindIndexer of this database, None unless OPTIONS enable WRITE_BEHIND."""
+        return get_indexer(self)
+
+    @contextmanager
+    def write_buffer(self, **options):
+        """
+        Collect the writes made through this connection, inserts, updates
+        and deletes of the compilers included, into _bulk batches, sent
+        when they are full or old enough and when the block ends. Options
+        are those of bulk.WriteBuffer. Failed actions raise BulkError when
+        the block ends normally and are logged when it raises. ::
+
+            with connection.write_buffer():
+                for event in events:
+                    event.save()
+        """
+        if self._write_buffer is not None:
+            # Flushed by the enclosing block
+            yield self._write_buffer
+            return
+
+        buffer = self._write_buffer = WriteBuffer(self.db_connection, **options)
+        try:
+            yield buffer
+        except:
+            exc_info = sys.exc_info()
+            self._write_buffer = None
+            try:
+                buffer.close()
+            except Exception:
+                # Not allowed to hide the error that ended the block
+                logger.exception("Sending the buffered writes failed")
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._write_buffer = None
+        buffer.close()
+
+    def indices_for(self, models=None):
+        """The indices holding the documents of ``models``, all by default."""
+        from django.db.models import get_models
+
+        es = self.db_connection
+        indices = []
+        if models is None:
+            indices.append(self.db_name)
+            models = [model for model in get_models() if partitioning(model) is not None]
+        for model in models:
+            if partitioning(model) is None:
+                partitions = [self.db_name]
+            else:
+                partitions = sorted(list_partitions(es, self.db_name, model))
+            indices.extend(index for index in partitions if index not in indices)
+        return indices
+
+    @contextmanager
+    def bulk_load(self, models=None, force_merge=False, max_num_segments=1,
+                  health_timeout=BULK_LOAD_HEALTH_TIMEOUT):
+        """
+        Tune the indices of ``models`` for a large load: refreshes and
+        replicas are turned off, and so is the client's forced refresh
+        before searches. On exit, errors included, the previous settings
+        are restored, the indices are force merged down to
+        ``max_num_segments`` with ``force_merge``, and the cluster health
+        is awaited until green, with a warning if it is not in time.
+        Failing to restore the indices raises when the block ends
+        normally and is logged when it raises. ::
+
+            with connection.bulk_load(models=[Event]):
+                load_events()
+        """
+        es = self.db_connection
+        if getattr(self, '_bulk_loading', False):
+            # Already tuned by an enclosing bulk_load
+            yield
+            return
+
+        indices = self.indices_for(models)
+        saved = dict((index, self._load_settings(es, index)) for index in indices)
+        autorefresh = getattr(es, 'autorefresh', None)
+        self._bulk_loading = True
+        try:
+            for index in indices:
+                es.update_settings(index, {"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+            if autorefresh is not None:
+                es.autorefresh = False
+            yield
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self._end_bulk_load(es, indices, saved, autorefresh, force_merge, max_num_segments, health_timeout)
+            except Exception:
+                # Not allowed to hide the error that ended the block
+                logger.exception("Restoring the indices after a bulk load failed")
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._end_bulk_load(es, indices, saved, autorefresh, force_merge, max_num_segments, health_timeout)
+
+    def _end_bulk_load(self, es, indices, saved, autorefresh, force_merge, max_num_segments, health_timeout):
+        self._bulk_loading = False
+        if autorefresh is not None:
+            es.autorefresh = autorefresh
+        for index in indices:
+            # A null refresh_interval puts back the default one
+            es.update_settings(index, {"index": saved[index]})
+        if force_merge:
+            es._send_request('POST', '/%s/_forcemerge' % ",".join(indices),
+                             params={"max_num_segments": max_num_segments})
+        else:
+            es.refresh(indices)
+        try:
+            health = es.cluster_health(indices=indices, wait_for_status='green', timeout=health_timeout)
+        except ElasticSearchException, e:
+            if getattr(e, "status", None) != REQUEST_TIMEOUT:
+                raise
+            # A single node cluster never gets the restored replicas
+            health = {"timed_out": True, "status": (getattr(e, "result", None) or {}).get("status")}
+        if health.get('timed_out'):
+            logger.warning("Indices %s not green after a bulk load: %s", ", ".join(indices), health.get('status'))
+
+    def _load_settings(self, es, index):
+        """The settings of ``index`` bulk_load changes, as they are now."""
+        result = es.get_settings(index).get(index, {}).get('settings', {})
+        settings = result.get('index', {})
+        refresh_interval = settings.get('refresh_interval', result.get('index.refresh_interval'))
+        replicas = settings.get('number_of_replicas', result.get('index.number_of_replicas'))
+        return {"refresh_interval": refresh_interval, "number_of_replicas": replicas}
+
+    def _stream_connection(self):
+        """A kept-alive connection of this thread, or a new one; and whether it was kept."""
+        idle = self._stream_connections.__dict__.setdefault("idle", [])
+        if idle:
+            return idle.pop(), True
+        return httplib.HTTPConnection(self.settings_dict['HOST'], int(self.settings_dict['PORT']),
+                                      timeout=self.db_connection.timeout), False
+
+    def stream_request(self, method, path, body=None, params=None):
+        """
+        Send a request over HTTP and return the connection and the response
+        unread, so its body can be parsed while it is being received. Pass
+        both to end_stream() once done with the response.
+        """
+        if params:
+            path = "%s?%s" % (path, urllib.urlencode(params))
+        if body is not None:
+            body = json.dumps(body, cls=Encoder)
+        while True:
+            connection, kept = self._stream_connection()
+            try:
+                connection.request(method, path, body, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if kept:
+                    # Closed by the server while idle
+                    continue
+                raise
+            break
+        if response.status >= 400:
+            error = response.read()
+            self.end_stream(connection, response)
+            raise ElasticSearchException(error, response.status)
+        return connection, response
+
+    def end_stream(self, connection, response):
+        """Keep ``connection`` for the next request of this thread if ``response`` was read to its end."""
+        if response.isclosed() and not response.will_close:
+            self._stream_connections.__dict__.setdefault("idle", []).append(connection)
+        else:
+            response.close()
+            connection.close()
+
+    def search_stream(self, body, indices, doc_types, **params):
+        """
+        Search and return ``(meta, hits)``: hits are decoded one at a time
+        from the response body, meta is filled with the other response
+        members as they are read.
+        """
+        es = self.db_connection
+        if getattr(es, "autorefresh", False) and not getattr(es, "refreshed", True):
+            # What the client does before its own searches, writes since
+            # the last one are searched too
+            es._send_request('POST', '/%s/_refresh' % ",".join(indices))
+            es.refreshed = True
+        path = "/%s/%s/_search" % (",".join(indices), ",".join(doc_types))
+        return self._stream_hits(*self.stream_request('POST', path, body, params))
+
+    def scroll_stream(self, scroll_id, scroll):
+        """The next page of a scroll, streamed like search_stream."""
+        return self._stream_hits(*self.stream_request('POST', '/_search/scroll',
+                                                      {"scroll": scroll, "scroll_id": scroll_id}))
+
+    def _stream_hits(self, connection, response):
+        meta = {}
+
+        def hits():
+            try:
+                for hit in Decoder().iter_hits(response, meta):
+                    yield hit
+            finally:
+                self.end_stream(connection, response)
+
+        return meta, hits()
@@ -0,0 +1,242 @@
+import json
+import logging
+import threading
+import time
+
+from django.db.utils import DatabaseError
+from pyes.exceptions import ElasticSearchException
+
+from .denormalize import add_related_documents
+from .serializer import Encoder
+
+__doc__ = "Index, update and delete actions sent in batches through the _bulk API"
+
+logger = logging.getLogger(__name__)
+
+# Actions sent in one _bulk request
+BULK_CHUNK_SIZE = 500
+
+# Encoded bytes after which a WriteBuffer sends its batch
+BULK_MAX_BYTES = 5 * 1024 * 1024
+
+# Seconds a buffered action waits at most before its batch is sent
+BULK_MAX_DELAY = 1.0
+
+# Attempts at actions rejected with 429 before they are reported as failed
+BULK_MAX_RETRIES = 8
+
+# Seconds waited before retrying rejected actions, doubled on each attempt
+BULK_BACKOFF = 0.5
+BULK_MAX_BACKOFF = 30
+
+# elasticsearch answers 429 when its write queues are full
+TOO_MANY_REQUESTS = 429
+
+
+class BulkError(DatabaseError):
+    """Actions of a _bulk request failed; ``failures`` describes each of them."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        super(BulkError, self).__init__("%d bulk actions failed, first: %r" % (len(failures), failures[:1]))
+
+
+def _metadata(index, doc_type, id, routing=None):
+    metadata = {"_index": index, "_type": doc_type}
+    if id is not None:
+        metadata["_id"] = id
+    if routing is not None:
+        metadata["routing"] = routing
+    return metadata
+
+
+def index_action(index, doc_type, id, document, routing=None):
+    return {"index": _metadata(index, doc_type, id, routing)}, document
+
+
+def update_action(index, doc_type, id, fields, routing=None):
+    return {"update": _metadata(index, doc_type, id, routing)}, {"doc": fields}
+
+
+def delete_action(index, doc_type, id, routing=None):
+    return {"delete": _metadata(index, doc_type, id, routing)}, None
+
+
+def encode_action(action):
+    """The _bulk lines of an action built by index_action and co."""
+    header, source = action
+    lines = json.dumps(header, cls=Encoder, separators=(',', ':')) + "\n"
+    if source is not None:
+        lines += json.dumps(source, cls=Encoder, separators=(',', ':')) + "\n"
+    return lines
+
+
+def instance_document(instance, connection=None):
+    """The document SQLInsertCompiler indexes for a model instance."""
+    document = {}
+    for field in instance._meta.local_fields:
+        value = field.get_db_prep_save(getattr(instance, field.attname), connection=connection)
+        if value is not None or not field.primary_key:
+            document[field.column] = value
+    add_related_documents(type(instance), document, instance)
+    return document
+
+
+def routing_column(model):
+    """The column whose value routes ``model``'s documents to a shard, or None."""
+    name = getattr(getattr(model, "ESMeta", None), "routing_field", None)
+    if not name:
+        return None
+    return model._meta.get_field(name).column
+
+
+def document_routing(model, document):
+    """The routing of ``document``, a dict of columns, None for models without a routing_field."""
+    column = routing_column(model)
+    if column is None:
+        return None
+    if document.get(column) is None:
+        raise DatabaseError("Documents of %s are routed by %s, which can't be None"
+                            % (model._meta.object_name, column))
+    return unicode(document[column])
+
+
+def _failure(item):
+    (op, result), = item.items()
+    return {"action": op, "_index": result.get("_index"), "_type": result.get("_type"),
+            "_id": result.get("_id"), "status": result.get("status"), "error": result.get("error")}
+
+
+def _unsent_failures(encoded, error):
+    """The failures of encoded actions whose _bulk request raised ``error``."""
+    failures = []
+    for lines in encoded:
+        (op, metadata), = json.loads(lines.split("\n", 1)[0]).items()
+        failures.append({"action": op, "_index": metadata.get("_index"), "_type": metadata.get("_type"),
+                         "_id": metadata.get("_id"), "status": getattr(error, "status", None),
+                         "error": unicode(error)})
+    return failures
+
+
+def send_bulk(es, encoded, max_retries=BULK_MAX_RETRIES, backoff=BULK_BACKOFF):
+    """
+    Send encoded actions in one _bulk request. Actions elasticsearch
+    rejects with 429, and whole requests it rejects so, are retried with
+    exponential backoff. Returns the failures of the other actions; deletes
+    of missing documents are not failures.
+    """
+    failures = []
+    attempt = 0
+    while encoded:
+        try:
+            result = es._send_request('POST', '/_bulk', "".join(encoded),
+                                      headers={"Content-Type": "application/x-ndjson"})
+            if getattr(es, "autorefresh", False):
+                # Like the client's own writes, refresh before the next search
+                es.refreshed = False
+        except ElasticSearchException, e:
+            if getattr(e, "status", None) != TOO_MANY_REQUESTS or attempt >= max_retries:
+                raise
+            rejected = encoded
+        else:
+            if not result.get("errors"):
+                return failures
+            rejected = []
+            for action, item in zip(encoded, result["items"]):
+                failure = _failure(item)
+                status = failure["status"]
+                if status == TOO_MANY_REQUESTS and attempt < max_retries:
+                    rejected.append(action)
+                elif status >= 300 and not (failure["action"] == "delete" and status == 404):
+                    failures.append(failure)
+        if rejected:
+            delay = min(backoff * 2 ** attempt, BULK_MAX_BACKOFF)
+            logger.info("%d bulk actions rejected, retrying in %.1fs", len(rejected), delay)
+            time.sleep(delay)
+            attempt += 1
+        encoded = rejected
+    return failures
+
+
+def bulk_write(es, actions, chunk_size=BULK_CHUNK_SIZE, raise_on_error=True):
+    """
+    Send ``actions`` in _bulk requests of ``chunk_size``. Returns the
+    failed actions, or raises BulkError for them with ``raise_on_error``.
+    """
+    failures = []
+    batch = []
+    for action in actions:
+        batch.append(encode_action(action))
+        if len(batch) >= chunk_size:
+            failures.extend(send_bulk(es, batch))
+            batch = []
+    if batch:
+        failures.extend(send_bulk(es, batch))
+    if failures and raise_on_error:
+        raise BulkError(failures)
+    return failures
+
+
+class WriteBuffer(object):
+    """
+    Actions collected into _bulk batches. A batch is sent once it holds
+    ``max_actions`` actions or ``max_bytes`` encoded bytes, once its first
+    action waited ``max_delay`` seconds, or on flush(). close() sends the
+    rest and raises BulkError for every action that failed, those of
+    batches whose request failed included.
+    """
+
+    def __init__(self, es, max_actions=BULK_CHUNK_SIZE, max_bytes=BULK_MAX_BYTES, max_delay=BULK_MAX_DELAY):
+        self.es = es
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.failures = []
+        self._batch = []
+        self._bytes = 0
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._batch)
+
+    def add(self, action):
+        encoded = encode_action(action)
+        with self._lock:
+            self._batch.append(encoded)
+            self._bytes += len(encoded)
+            if len(self._batch) >= self.max_actions or self._bytes >= self.max_bytes:
+                self.flush()
+            elif self._timer is None and self.max_delay is not None:
+                self._timer = threading.Timer(self.max_delay, self._flush_late)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_late(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Sending buffered bulk actions failed")
+
+    def flush(self):
+        """Send the batch now. Returns the failures of its actions."""
+        with self._lock:
+            batch, self._batch, self._bytes = self._batch, [], 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not batch:
+                return []
+            try:
+                failures = send_bulk(self.es, batch)
+            except Exception, e:
+                # Reported again by close(), even when a timer sent the batch
+                self.failures.extend(_unsent_failures(batch, e))
+                raise
+            self.failures.extend(failures)
+            return failures
+
+    def close(self):
+        self.flush()
+        if self.failures:
+            raise BulkError(self.failures)
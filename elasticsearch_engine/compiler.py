@@ -1,94 +1,174 @@
 import sys
 import re
+import uuid
 from datetime import datetime
 from functools import wraps
 import logging
 
 from django.db.models.sql.compiler import SQLCompiler
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.utils import DatabaseError
 from django.db.models.fields import NOT_PROVIDED
-from pyes import MatchAllQuery, RangeQuery, ESRange, \
-    TermQuery, ConstantScoreQuery, TermFilter, TermsFilter, NotFilter, RegexTermFilter
 from djangotoolbox.db.basecompiler import NonrelQuery, NonrelCompiler, \
     NonrelInsertCompiler, NonrelDeleteCompiler
 from django.db.models.fields import AutoField
+from django.db.models.sql.where import OR
+from django.utils.tree import Node
+
+from .bulk import delete_action, document_routing, index_action, routing_column, update_action
+from .cursor import delete_by_query, iter_hits, _regexp_clause
+from .denormalize import add_related_documents
+from .fields import EmbeddedModelField
+from .optimizer import MATCH_NONE, keyword_fields, multi_valued_fields, optimize, pinned_values
+from .partition import PRUNED_SEARCH_PARAMS, document_index, partitioning, search_indices
+from .query import MATCH_ALL, and_clauses, not_clause, or_clauses
+from .tenancy import tag_document
 
 
 TYPE_MAPPING_FROM_DB = {
-    'unicode': lambda val: unicode(val),
-    'int': lambda val: int(val),
-    'float': lambda val: float(val),
-    'bool': lambda val: bool(val),
+    'unicode': unicode,
+    'int': int,
+    'float': float,
+    'bool': bool,
 }
 
 TYPE_MAPPING_TO_DB = {
-    'unicode': lambda val: unicode(val),
-    'int': lambda val: int(val),
-    'float': lambda val: float(val),
-    'bool': lambda val: bool(val),
+    'unicode': unicode,
+    'int': int,
+    'float': float,
+    'bool': bool,
     'date': lambda val: datetime(val.year, val.month, val.day),
     'time': lambda val: datetime(2000, 1, 1, val.hour, val.minute,
                                  val.second, val.microsecond),
 }
 
 OPERATORS_MAP = {
-    'exact': lambda val: val,
-    'iexact': lambda val: val,  # tofix
-    'startswith': lambda val: r'^%s' % re.escape(val),
-    'istartswith': lambda val: r'^%s' % re.escape(val),
-    'endswith': lambda val: r'%s$' % re.escape(val),
-    'iendswith': lambda val: r'%s$' % re.escape(val),
-    'contains': lambda val: r'%s' % re.escape(val),
-    'icontains': lambda val: r'%s' % re.escape(val),
-    'regex': lambda val: val,
-    'iregex': lambda val: re.compile(val, re.IGNORECASE),
-    'gt': lambda val: {"_from": val, "include_lower": False},
-    'gte': lambda val: {"_from": val, "include_lower": True},
-    'lt': lambda val: {"_to": val, "include_upper": False},
-    'lte': lambda val: {"_to": val, "include_upper": True},
-    'range': lambda val: {"_from": val[0], "_to": val[1], "include_lower": True, "include_upper": True},
-    'year': lambda val: {"_from": val[0], "_to": val[1], "include_lower": True, "include_upper": False},
-    'isnull': lambda val: None if val else {'$ne': None},
-    'in': lambda val: val,
+    'exact': lambda column, val: {"term": {column: val}} if val is not None else _missing(column),
+    'iexact': lambda column, val: {"term": {column: val}},  # tofix
+    'startswith': lambda column, val: _regexp_clause(column, re.compile(r'^%s' % re.escape(val))),
+    'istartswith': lambda column, val: _regexp_clause(column, re.compile(r'^%s' % re.escape(val))),
+    'endswith': lambda column, val: _regexp_clause(column, re.compile(r'%s$' % re.escape(val))),
+    'iendswith': lambda column, val: _regexp_clause(column, re.compile(r'%s$' % re.escape(val))),
+    'contains': lambda column, val: _regexp_clause(column, re.compile(re.escape(val))),
+    'icontains': lambda column, val: _regexp_clause(column, re.compile(re.escape(val))),
+    'regex': lambda column, val: _regexp_clause(column, re.compile(val)),
+    'iregex': lambda column, val: _regexp_clause(column, re.compile(val, re.IGNORECASE)),
+    'gt': lambda column, val: {"range": {column: {"gt": val}}},
+    'gte': lambda column, val: {"range": {column: {"gte": val}}},
+    'lt': lambda column, val: {"range": {column: {"lt": val}}},
+    'lte': lambda column, val: {"range": {column: {"lte": val}}},
+    'range': lambda column, val: {"range": {column: {"gte": val[0], "lte": val[1]}}},
+    'year': lambda column, val: {"range": {column: {"gte": val[0], "lt": val[1]}}},
+    'isnull': lambda column, val: _missing(column) if val else {"exists": {"field": column}},
+    'in': lambda column, val: {"terms": {column: list(val)}},
 }
 
-NEGATED_OPERATORS_MAP = {
-    'exact': lambda val: {'$ne': val},
-    'gt': lambda val: {"_to": val, "include_upper": True},
-    'gte': lambda val: {"_to": val, "include_upper": False},
-    'lt': lambda val: {"_from": val, "include_lower": True},
-    'lte': lambda val: {"_from": val, "include_lower": False},
-    'isnull': lambda val: {'$ne': None} if val else None,
-    'in': lambda val: {'$nin': val},
-}
 
+def _missing(column):
+    return not_clause({"exists": {"field": column}})
 
-def _get_mapping(db_type, value, mapping):
-    # TODO - comments. lotsa comments
 
-    if value == NOT_PROVIDED:
-        return None
+# Value converters resolved per db_type, one cache per direction
+_FROM_DB_CONVERTERS = {}
+_TO_DB_CONVERTERS = {}
+
+# Row converters keyed by (connection alias, model, selected fields)
+_ROW_CONVERTERS = {}
+
+
+def _make_converter(db_type, mapping, cache):
+    """
+    Resolve the conversion of db_type against mapping. Returns None when
+    values of that type are stored as they are.
+    """
+    if db_type is not None and db_type.startswith('ListField:'):
+        item_converter = get_converter(db_type.split(':', 1)[1], mapping, cache)
+        if item_converter is None:
+            return None
+
+        def convert_list(value):
+            if isinstance(value, (list, tuple)):
+                return [item_converter(item) for item in value]
+            return value
 
-    if value is None:
+        return convert_list
+
+    func = mapping.get(db_type)
+    if func is None:
         return None
 
-    if db_type in mapping:
-        _func = mapping[db_type]
-    else:
-        _func = lambda val: val
-    # TODO - what if the data is represented as list on the python side?
-    if isinstance(value, list):
-        return map(_func, value)
+    def convert(value):
+        if value is None or value is NOT_PROVIDED:
+            return None
+        if isinstance(value, list):
+            return map(func, value)
+        return func(value)
+
+    return convert
+
+
+def get_converter(db_type, mapping, cache):
+    try:
+        return cache[db_type]
+    except KeyError:
+        converter = cache[db_type] = _make_converter(db_type, mapping, cache)
+        return converter
 
-    return _func(value)
+
+def _convert(converter, value):
+    if value is NOT_PROVIDED:
+        return None
+    if converter is None:
+        return value
+    return converter(value)
 
 
 def python2db(db_type, value):
-    return _get_mapping(db_type, value, TYPE_MAPPING_TO_DB)
+    return _convert(get_converter(db_type, TYPE_MAPPING_TO_DB, _TO_DB_CONVERTERS), value)
 
 
 def db2python(db_type, value):
-    return _get_mapping(db_type, value, TYPE_MAPPING_FROM_DB)
+    return _convert(get_converter(db_type, TYPE_MAPPING_FROM_DB, _FROM_DB_CONVERTERS), value)
+
+
+def _get_field_converter(field, connection):
+    if isinstance(field, EmbeddedModelField):
+        # Embedded documents are rebuilt from the field's schema
+        return field.to_python
+    return get_converter(field.db_type(connection=connection), TYPE_MAPPING_FROM_DB, _FROM_DB_CONVERTERS)
+
+
+def get_row_converter(connection, model, fields):
+    """
+    Build, once per (connection, model, fields), a function turning an
+    entity dict into the list of python values for fields.
+    """
+    key = (connection.alias, model, tuple(fields))
+    try:
+        return _ROW_CONVERTERS[key]
+    except KeyError:
+        pass
+
+    plan = [(field.column, field.name, field.null, field.get_default, _get_field_converter(field, connection))
+            for field in fields]
+
+    def convert_row(entity):
+        result = []
+        append = result.append
+        for column, name, null, get_default, converter in plan:
+            value = entity.get(column, NOT_PROVIDED)
+            if value is NOT_PROVIDED:
+                value = get_default()
+            if value is None:
+                if not null:
+                    raise DatabaseError("Non-nullable field %s can't be None!" % name)
+            elif converter is not None:
+                value = converter(value)
+            append(value)
+        return result
+
+    _ROW_CONVERTERS[key] = convert_row
+    return convert_row
 
 
 def safe_call(func):
@@ -113,7 +193,7 @@ class DBQuery(NonrelQuery):
         super(DBQuery, self).__init__(compiler, fields)
         self._connection = self.connection.db_connection
         self._ordering = []
-        self.db_query = ConstantScoreQuery()
+        self.db_query = MATCH_ALL
 
     # This is needed for debugging
     def __repr__(self):
@@ -121,104 +201,147 @@ class DBQuery(NonrelQuery):
 
     @safe_call
     def fetch(self, low_mark, high_mark):
-        results = self._get_results()
-
-        if low_mark > 0:
-            results = results[low_mark:]
+        limit = None
         if high_mark is not None:
-            results = results[low_mark:high_mark - low_mark]
+            limit = high_mark - low_mark
 
-        for hit in results:
-            entity = hit.get_data()
-            entity['id'] = hit.meta.id
+        for hit in self._get_results(low_mark, limit):
+            entity = hit.get('_source') or {}
+            entity['id'] = hit['_id']
             yield entity
 
     @safe_call
     def count(self, limit=None):
-        query = self.db_query
-        if self.db_query.is_empty():
-            query = MatchAllQuery()
-
-        res = self._connection.count(query, doc_types=self.query.model._meta.db_table)
+        self.connection.flush_write_buffer()
+        query = self._get_query()
+        indices = self._get_indices(query)
+        if query == MATCH_NONE or not indices:
+            return 0
+        res = self._connection.count({"query": query}, indices=indices,
+                                     doc_types=[self.query.model._meta.db_table], **self._get_params(query))
         return res["count"]
 
+    @safe_call
+    def documents(self):
+        """
+        @returns: the (_index, _id, _routing) of every matching document
+        """
+        return [(hit['_index'], hit['_id'], hit.get('_routing')) for hit in self._get_results()]
+
     @safe_call
     def delete(self):
-        self._collection.remove(self.db_query)
+        self.connection.flush_write_buffer()
+        query = self._get_query()
+        indices = self._get_indices(query)
+        if query != MATCH_NONE and indices:
+            delete_by_query(self._connection, indices, [self.query.model._meta.db_table], query,
+                            **self._get_params(query))
 
     @safe_call
     def order_by(self, ordering):
+        meta = self.query.get_meta()
         for order in ordering:
             if order.startswith('-'):
-                order, direction = order[1:], {"reverse": True}
+                name, direction = order[1:], 'desc'
             else:
-                direction = 'desc'
-            self._ordering.append({order: direction})
+                name, direction = order, 'asc'
+            field = meta.get_field(name)
+            column = '_id' if field.primary_key else field.column
+            self._ordering.append({column: direction})
 
-    # This function is used by the default add_filters() implementation
+    @safe_call
+    def add_filters(self, filters):
+        """
+        Compile the whole where tree into one bool clause, so OR connected
+        and negated groups reach elasticsearch as they are.
+        """
+        self.db_query = and_clauses([self.db_query, self._compile_where(filters)])
+
+    def _compile_where(self, node):
+        clauses = []
+        for child in self._get_children(node.children):
+            if isinstance(child, Node):
+                clauses.append(self._compile_where(child))
+            else:
+                column, lookup_type, db_type, value = self._decode_child(child)
+                clauses.append(self._filter_clause(column, lookup_type, db_type, value))
+        clause = or_clauses(clauses) if node.connector == OR else and_clauses(clauses)
+        return not_clause(clause) if node.negated else clause
+
+    # Single constraints, ANDed with the rest of the query
     @safe_call
     def add_filter(self, column, lookup_type, negated, db_type, value):
+        clause = self._filter_clause(column, lookup_type, db_type, value)
+        self.db_query = and_clauses([self.db_query, not_clause(clause) if negated else clause])
+
+    def _filter_clause(self, column, lookup_type, db_type, value):
         if column == self.query.get_meta().pk.column:
             column = '_id'
-        # Emulated/converted lookups
-
-        if negated and lookup_type in NEGATED_OPERATORS_MAP:
-            op = NEGATED_OPERATORS_MAP[lookup_type]
-            negated = False
+        if lookup_type not in OPERATORS_MAP:
+            raise DatabaseError("Lookup type %r isn't supported" % lookup_type)
+        if isinstance(value, (list, tuple)):
+            value = [self.convert_value_for_db(db_type, item) for item in value]
         else:
-            op = OPERATORS_MAP[lookup_type]
-        value = op(self.convert_value_for_db(db_type, value))
+            value = self.convert_value_for_db(db_type, value)
+        return OPERATORS_MAP[lookup_type](column, value)
 
-        queryf = self._get_query_type(column, lookup_type, db_type, value)
+    def _get_query(self):
+        """
+        @returns: the optimized query, MATCH_NONE when nothing can match
+        """
+        model = self.query.model
+        return optimize(self.db_query, multi_valued_fields(model), keyword_fields(model))
 
-        if negated:
-            self.db_query.add([NotFilter(queryf)])
-        else:
-            self.db_query.add([queryf])
-
-    def _get_query_type(self, column, lookup_type, db_type, value):
-        if db_type == "unicode":
-            if lookup_type == "exact" or lookup_type == "iexact":
-                q = TermQuery(column, value)
-                return q
-            if lookup_type == "startswith" or lookup_type == "istartswith":
-                return RegexTermFilter(column, value)
-            if lookup_type == "endswith" or lookup_type == "iendswith":
-                return RegexTermFilter(column, value)
-            if lookup_type == "contains" or lookup_type == "icontains":
-                return RegexTermFilter(column, value)
-            if lookup_type == "regex" or lookup_type == "iregex":
-                return RegexTermFilter(column, value)
-
-        if db_type == "datetime" or db_type == "date":
-            if lookup_type == "exact" or lookup_type == "iexact":
-                return TermFilter(column, value)
-
-        # TermFilter, TermsFilter
-        if lookup_type in ["gt", "gte", "lt", "lte", "range", "year"]:
-            value['field'] = column
-            return RangeQuery(ESRange(**value))
-        if lookup_type == "in":
-            #            terms = [TermQuery(column, val) for val in value]
-            #            if len(terms) == 1:
-            #                return terms[0]
-            #            return BoolQuery(should=terms)
-            return TermsFilter(field=column, values=value)
-        raise NotImplemented
-
-    def _get_results(self):
+    def _get_indices(self, query):
+        """
+        @returns: the indices the query needs, only the overlapping
+        partitions of a partitioned model
+        """
+        return search_indices(self._connection, self.connection.db_name, self.query.model, query)
+
+    def _get_params(self, query):
+        """
+        @returns: the request parameters of the query, the routing of the
+        shards holding its documents when it pins the model's routing_field
+        """
+        params = {}
+        if partitioning(self.query.model) is not None:
+            params.update(PRUNED_SEARCH_PARAMS)
+        column = routing_column(self.query.model)
+        values = column and pinned_values(query, column)
+        if values:
+            params["routing"] = ",".join(unicode(value) for value in values)
+        return params
+
+    def _get_source_filter(self):
         """
-        @returns: elasticsearch iterator over results
+        @returns: the _source includes for the selected fields, or None
+        when every field is selected
+        """
+        if self.fields is None:
+            return None
+        meta = self.query.get_meta()
+        columns = [field.column for field in self.fields if not field.primary_key]
+        if len(columns) == len([field for field in meta.local_fields if not field.primary_key]):
+            return None
+        return columns or False
+
+    def _get_results(self, skip=0, limit=None):
+        """
+        @returns: elasticsearch iterator over the raw hits
         defined by self.query
         """
-        query = self.db_query
-        if self.db_query.is_empty():
-            query = MatchAllQuery()
+        body = {"query": self._get_query()}
+        indices = self._get_indices(body["query"])
+        if not indices:
+            return iter(())
         if self._ordering:
-            query.sort = self._ordering
-        # print "query", self.query.tables, query
-        return self._connection.search(query, indices=[self.connection.db_name],
-                                       doc_types=self.query.model._meta.db_table)
+            body["sort"] = self._ordering
+        source = self._get_source_filter()
+        if source is not None:
+            body["_source"] = source
+        return iter_hits(self.connection, indices, [self.query.model._meta.db_table], body,
+                         skip=skip, limit=limit, params=self._get_params(body["query"]))
 
 
 class SQLCompiler(NonrelCompiler):
@@ -227,30 +350,16 @@ class SQLCompiler(NonrelCompiler):
     """
     query_class = DBQuery
 
+    def _make_result(self, entity, fields):
+        return get_row_converter(self.connection, self.query.model, fields)(entity)
+
     def convert_value_from_db(self, db_type, value):
-        # Handle list types
-        if db_type is not None and \
-                isinstance(value, (list, tuple)) and len(value) and \
-                db_type.startswith('ListField:'):
-            db_sub_type = db_type.split(':', 1)[1]
-            value = [self.convert_value_from_db(db_sub_type, subvalue)
-                     for subvalue in value]
-        else:
-            value = db2python(db_type, value)
-        return value
+        return db2python(db_type, value)
 
     # This gets called for each field type when you insert() an entity.
     # db_type is the string that you used in the DatabaseCreation mapping
     def convert_value_for_db(self, db_type, value):
-        if db_type is not None and \
-                isinstance(value, (list, tuple)) and len(value) and \
-                db_type.startswith('ListField:'):
-            db_sub_type = db_type.split(':', 1)[1]
-            value = [self.convert_value_for_db(db_sub_type, subvalue)
-                     for subvalue in value]
-        else:
-            value = python2db(db_type, value)
-        return value
+        return python2db(db_type, value)
 
     def insert_params(self):
         conn = self.connection
@@ -264,6 +373,12 @@ class SQLCompiler(NonrelCompiler):
 
         return params
 
+    def _matching_documents(self):
+        try:
+            return self.build_query([self.query.get_meta().pk]).documents()
+        except EmptyResultSet:
+            return []
+
     def _get_ordering(self):
         if not self.query.default_ordering:
             ordering = self.query.order_by
@@ -296,45 +411,83 @@ class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
     @safe_call
     def insert(self, data, return_id=False):
         pk_column = self.query.get_meta().pk.column
-        pk = None
-        if pk_column in data:
-            pk = data[pk_column]
+        pk = data.get(pk_column)
+        if pk is None:
+            # Chosen here rather than by elasticsearch, so the insert can be buffered
+            pk = str(uuid.uuid4())
         db_table = self.query.get_meta().db_table
+        objs = getattr(self.query, 'objs', None)
+        add_related_documents(self.query.model, data, objs[0] if objs and len(objs) == 1 else None)
+        tag_document(self.connection, self.query.model, data)
         logging.debug("Insert data %s: %s" % (db_table, data))
-        # print("Insert data %s: %s" % (db_table, data))
-        res = self.connection.db_connection.index(data, self.connection.db_name, db_table, id=pk)
-        #print "Insert result", res
-        return res['_id']
+        index = document_index(self.connection.db_name, self.query.model, data)
+        routing = document_routing(self.query.model, data)
+        self.connection.write(index_action(index, db_table, pk, data, routing))
+        return pk
 
 
-# TODO: Define a common nonrel API for updates and add it to the nonrel
-# backend base classes and port this code to that API
 class SQLUpdateCompiler(SQLCompiler):
-    def execute_sql(self, return_id=False):
+    @safe_call
+    def execute_sql(self, result_type=None):
         """
-        self.query - the data that should be inserted
+        Partially update every matching document.
+
+        @returns: the number of documents updated
         """
         data = {}
-        for (field, value), column in zip(self.query.values, self.query.columns):
-            data[column] = python2db(field.db_type(connection=self.connection), value)
-        # every object should have a unique pk
-        pk_field = self.query.model._meta.pk
-        pk_name = pk_field.attname
+        for field, _, value in self.query.values:
+            if hasattr(value, 'prepare_database_save'):
+                value = value.prepare_database_save(field)
+            else:
+                value = field.get_db_prep_save(value, connection=self.connection)
+            data[field.column] = python2db(field.db_type(connection=self.connection), value)
 
         db_table = self.query.get_meta().db_table
-        res = self.connection.db_connection.index(data, self.connection.db_name, db_table)
+        documents = self._matching_documents()
+        for index, pk, routing in documents:
+            fields = self._document_fields(data, index, routing)
+            self.connection.write(update_action(index, db_table, pk, fields, routing))
+        return len(documents)
 
-        return res['_id']
+    def _document_fields(self, data, index, routing):
+        """
+        @returns: the fields of ``data`` to update in the document of
+        ``index`` routed by ``routing``. save() sends every field, so
+        unchanged partition and routing columns are left out; changing
+        them would move the document to another index or shard.
+        """
+        model = self.query.model
+        fields = data
+        partitions = partitioning(model)
+        if partitions is not None and partitions[0].column in data:
+            column = partitions[0].column
+            if document_index(self.connection.db_name, model, {column: data[column]}) != index:
+                raise DatabaseError("%s can't be updated, documents are partitioned by it" % partitions[0].name)
+            fields = dict(fields)
+            del fields[column]
+        column = routing_column(model)
+        if column is not None and column in data:
+            if data[column] is None or unicode(data[column]) != routing:
+                raise DatabaseError("%s can't be updated, documents are routed by it" % column)
+            fields = dict(fields)
+            del fields[column]
+        return fields
 
 
 class SQLDeleteCompiler(NonrelDeleteCompiler, SQLCompiler):
-    def execute_sql(self, return_id=False):
+    @safe_call
+    def execute_sql(self, result_type=None):
         """
-        self.query - the data that should be inserted
+        Delete every matching document, by id so deletes can be buffered.
         """
         db_table = self.query.get_meta().db_table
-        if len(self.query.where.children) == 1 and isinstance(self.query.where.children[0][0].field, AutoField) and \
-                        self.query.where.children[0][1] == "in":
-            for pk in self.query.where.children[0][3]:
-                self.connection.db_connection.delete(self.connection.db_name, db_table, pk)
-        return
\ No newline at end of file
+        children = self.query.where.children
+        if len(children) == 1 and not isinstance(children[0], Node) and \
+                isinstance(children[0][0].field, AutoField) and children[0][1] == "in" and \
+                partitioning(self.query.model) is None and routing_column(self.query.model) is None:
+            documents = [(self.connection.db_name, pk, None) for pk in children[0][3]]
+        else:
+            # The partition and routing of each document are only known from the search
+            documents = self._matching_documents()
+        for index, pk, routing in documents:
+            self.connection.write(delete_action(index, db_table, pk, routing))
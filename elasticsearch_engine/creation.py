@@ -48,12 +48,54 @@ class DatabaseCreation(NonrelDatabaseCreation):
         return []
 
     def sql_create_model(self, model, style, known_models=set()):
-        from mapping import model_to_mapping
+        from mapping import model_to_mapping, mapping_is_current
+        from partition import index_template, partition_alias, partitioning
+        from tenancy import all_tenants, get_tenant
+
+        if get_tenant() is None:
+            # syncdb puts the mappings of the database's own index, which
+            # tenants without an index of their own share
+            with all_tenants():
+                return self.sql_create_model(model, style, known_models)
 
         mappings = model_to_mapping(model)
-        self.connection.db_connection.put_mapping(model._meta.db_table, {mappings.name: mappings.as_dict()})
+        mapping = mappings.as_dict()
+        doc_type = model._meta.db_table
+        if partitioning(model) is not None:
+            # Partitions are created by the first document written to them
+            db_name = self.connection.db_name
+            self.connection.db_connection._send_request('PUT', '/_template/%s' % partition_alias(db_name, model),
+                                                        index_template(db_name, model, mapping))
+            return [], {}
+        live = self._get_live_mappings()
+        if doc_type not in live or not mapping_is_current(live[doc_type], mapping):
+            self.connection.db_connection.put_mapping(doc_type, {mappings.name: mapping},
+                                                      indices=[self.connection.db_name])
+            live[doc_type] = mapping
         return [], {}
 
+    def _get_live_mappings(self):
+        """
+        Mappings of every doc type in the index, fetched with a single
+        request per index, tenants' indices included, and kept up to date
+        as mappings are put.
+        """
+        es = self.connection.db_connection
+        db_name = self.connection.db_name
+        if not hasattr(self, '_live_mappings'):
+            self._live_mappings = {}
+        if db_name not in self._live_mappings:
+            try:
+                result = es.get_mapping(indices=[db_name])
+            except NotFoundException:
+                result = {}
+            if db_name not in result and len(result) == 1:
+                # Keyed by the index behind an alias
+                result = result.values()[0]
+            result = result.get(db_name, result)
+            self._live_mappings[db_name] = result.get("mappings", result)
+        return self._live_mappings[db_name]
+
     def set_autocommit(self):
         "Make sure a connection is in autocommit mode."
         pass
@@ -109,6 +151,7 @@ class DatabaseCreation(NonrelDatabaseCreation):
         self.connection.settings_dict['NAME'] = old_database_name
 
     def _drop_database(self, database_name):
+        self._live_mappings = {}
         try:
             self.connection.db_connection.delete_index(database_name)
         except NotFoundException:
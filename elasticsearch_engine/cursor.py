@@ -0,0 +1,605 @@
+import base64
+import copy
+import json
+import multiprocessing
+import re
+import sys
+import threading
+import traceback
+from Queue import Queue, Empty, Full
+
+from itertools import islice
+
+from .aggregations import distinct_values
+from .optimizer import MATCH_NONE, keyword_fields, multi_valued_fields, optimize
+from .partition import model_indices
+
+__doc__ = "Elasticsearch backed collection and cursor used by the manager QuerySet"
+
+RE_TYPE = type(re.compile(''))
+
+# Page size used when results are walked with the scroll API
+SCROLL_PAGE_SIZE = 500
+
+# How long elasticsearch keeps a scroll context alive between two pages
+SCROLL_TIMEOUT = '1m'
+
+# Seconds a prefetch worker waits on a full buffer before checking whether
+# the consumer went away
+PREFETCH_POLL_INTERVAL = 0.1
+
+# Deepest from + size elasticsearch accepts by default (index.max_result_window)
+MAX_RESULT_WINDOW = 10000
+
+# Sort key breaking ties between documents in keyset pagination
+TIEBREAKER = '_id'
+
+RANGE_OPERATORS = {'$gt': 'gt', '$gte': 'gte', '$lt': 'lt', '$lte': 'lte'}
+
+
+def _regexp_clause(field, regex):
+    """
+    Anchors are implicit in elasticsearch regexps, so ``^``/``$`` are
+    stripped and their absence is turned into a wildcard.
+    """
+    pattern = regex.pattern
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    else:
+        pattern = '.*' + pattern
+    if pattern.endswith('$'):
+        pattern = pattern[:-1]
+    else:
+        pattern += '.*'
+    return {"regexp": {field: pattern}}
+
+
+def _compile_value(field, value, must, must_not):
+    if isinstance(value, RE_TYPE):
+        must.append(_regexp_clause(field, value))
+        return
+    if not isinstance(value, dict):
+        must.append({"term": {field: value}})
+        return
+
+    bounds = {}
+    for op, arg in value.items():
+        if op in RANGE_OPERATORS:
+            bounds[RANGE_OPERATORS[op]] = arg
+        elif op == '$ne':
+            _compile_value(field, arg, must_not, must)
+        elif op == '$in':
+            must.append({"terms": {field: list(arg)}})
+        elif op == '$nin':
+            must_not.append({"terms": {field: list(arg)}})
+        elif op == '$all':
+            must.extend({"term": {field: item}} for item in arg)
+        elif op == '$exists':
+            (must if arg else must_not).append({"exists": {"field": field}})
+        elif op == '$size':
+            must.append({"script": {"script": {"source": "doc[params.field].size() == params.size",
+                                               "params": {"field": field, "size": arg}}}})
+        elif op == '$mod':
+            must.append({"script": {"script": {"source": "doc[params.field].value % params.divisor == params.remainder",
+                                               "params": {"field": field, "divisor": arg[0], "remainder": arg[1]}}}})
+        else:
+            raise ValueError("Unsupported operator %r on %s" % (op, field))
+    if bounds:
+        must.append({"range": {field: bounds}})
+
+
+def spec_to_clauses(spec):
+    """
+    The clauses a Mongo style spec, as built by ``QuerySet._transform_query``,
+    requires and forbids.
+    """
+    must, must_not = [], []
+    for field, value in spec.items():
+        _compile_value(field, value, must, must_not)
+    return must, must_not
+
+
+def spec_to_query(spec, where=None):
+    """
+    Translate a Mongo style spec into an elasticsearch query. ``where`` is
+    an extra clause ANDed in.
+    """
+    must, must_not = spec_to_clauses(spec)
+    if where is not None:
+        must.append(where)
+    if not must and not must_not:
+        return {"match_all": {}}
+    query = {}
+    if must:
+        query["filter"] = must
+    if must_not:
+        query["must_not"] = must_not
+    return {"bool": query}
+
+
+def _search_page(connection, indices, doc_types, body, **params):
+    """
+    Run one search. Returns the response members other than the hits, and
+    the hits, which are decoded as they are received when the connection
+    streams results.
+    """
+    # Writes buffered by the connection are searched too
+    connection.flush_write_buffer()
+    if connection.stream_results:
+        return connection.search_stream(body, indices, doc_types, **params)
+    result = connection.db_connection.search_raw(body, indices=indices, doc_types=doc_types, **params)
+    return result, result["hits"]["hits"]
+
+
+def _scroll_page(connection, scroll_id):
+    if connection.stream_results:
+        return connection.scroll_stream(scroll_id, SCROLL_TIMEOUT)
+    result = connection.db_connection.search_scroll(scroll_id, scroll=SCROLL_TIMEOUT)
+    return result, result["hits"]["hits"]
+
+
+def delete_by_query(es, indices, doc_types, query, **params):
+    """Delete the documents matching ``query`` with the _delete_by_query API."""
+    path = "/%s/%s/_delete_by_query" % (",".join(indices), ",".join(doc_types))
+    return es._send_request('POST', path, {"query": query}, params=params)
+
+
+def encode_token(sort_values):
+    """An opaque cursor token for the position after a hit's sort values."""
+    return base64.urlsafe_b64encode(json.dumps(sort_values, separators=(',', ':')))
+
+
+def decode_token(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        values = None
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor token %r" % (token,))
+    return values
+
+
+def _iter_keyset(connection, indices, doc_types, body, skip, limit, page_size, params):
+    """
+    Walk a sorted search with search_after, each page starting after the
+    sort values of the previous one's last hit.
+    """
+    while limit is None or limit:
+        size = page_size if limit is None else min(page_size, skip + limit)
+        meta, hits = _search_page(connection, indices, doc_types, dict(body, size=size), **params)
+        received, last = 0, None
+        for hit in hits:
+            received += 1
+            last = hit
+            if skip:
+                skip -= 1
+                continue
+            if limit is not None:
+                if not limit:
+                    return
+                limit -= 1
+            yield hit
+        if received < size:
+            return
+        body = dict(body, search_after=last["sort"])
+
+
+def iter_hits(connection, indices, doc_types, body, skip=0, limit=None, page_size=SCROLL_PAGE_SIZE,
+              keyset=False, params=None):
+    """
+    Yield raw hits for ``body``. Windows that fit in one page are fetched with
+    from/size, anything larger is walked with the scroll API. With ``keyset``
+    the sorted ``body`` is walked with search_after instead. ``params`` are
+    added to the search requests, e.g. routing.
+    """
+    params = params or {}
+    if body.get("query") == MATCH_NONE:
+        return
+    if keyset:
+        for hit in _iter_keyset(connection, indices, doc_types, body, skip, limit, page_size, params):
+            yield hit
+        return
+    if limit is not None and limit <= page_size and skip + limit <= MAX_RESULT_WINDOW:
+        body = dict(body, **{"from": skip, "size": limit})
+        meta, hits = _search_page(connection, indices, doc_types, body, **params)
+        for hit in hits:
+            yield hit
+        return
+
+    body = dict(body, size=page_size)
+    meta, hits = _search_page(connection, indices, doc_types, body, scroll=SCROLL_TIMEOUT, **params)
+    scroll_id = None
+    try:
+        while True:
+            received = 0
+            for hit in hits:
+                received += 1
+                if skip:
+                    skip -= 1
+                    continue
+                if limit is not None:
+                    if not limit:
+                        return
+                    limit -= 1
+                yield hit
+            scroll_id = meta.get("_scroll_id", scroll_id)
+            if not received:
+                return
+            meta, hits = _scroll_page(connection, scroll_id)
+    finally:
+        scroll_id = meta.get("_scroll_id", scroll_id)
+        if scroll_id:
+            try:
+                connection.db_connection._send_request('DELETE', '/_search/scroll', {"scroll_id": [scroll_id]})
+            except Exception:
+                pass
+
+
+def chunked(iterable, size):
+    """Lists of up to ``size`` items of ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def prefetched(iterable, prefetch=1):
+    """
+    Iterate over ``iterable`` from a worker thread that runs up to
+    ``prefetch`` items ahead of the caller, through a bounded buffer. The
+    worker stops when the caller stops iterating, and its errors are raised
+    in the caller.
+    """
+    buffer = Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def work():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not _put(buffer, stop, (item, None)):
+                    return
+            _put(buffer, stop, (done, None))
+        except Exception:
+            _put(buffer, stop, (done, sys.exc_info()))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    worker = threading.Thread(target=work, name="es-prefetch")
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error:
+                    raise error[0], error[1], error[2]
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _put(buffer, stop, item):
+    while not stop.is_set():
+        try:
+            buffer.put(item, timeout=PREFETCH_POLL_INTERVAL)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _read_slice(connection, indices, doc_types, body, page_size, buffer, stop, forked):
+    if forked:
+        connection.reconnect()
+    try:
+        hits = iter_hits(connection, indices, doc_types, body, page_size=page_size)
+        try:
+            for chunk in chunked(hits, page_size):
+                if not _put(buffer, stop, ("chunk", [hit_to_document(hit) for hit in chunk])):
+                    return
+        finally:
+            hits.close()
+        _put(buffer, stop, ("done", None))
+    except Exception:
+        _put(buffer, stop, ("error", traceback.format_exc() if forked else sys.exc_info()))
+
+
+def iter_slices(connection, indices, doc_types, body, slices, page_size=SCROLL_PAGE_SIZE, processes=False):
+    """
+    Yield the documents for ``body`` read with a sliced scroll, each slice
+    fetched and decoded by its own thread, or its own process with
+    ``processes``, in no particular order. At most two pages per slice
+    wait in the buffer between the workers and the caller.
+    """
+    if body.get("query") == MATCH_NONE:
+        return
+    if processes:
+        buffer, stop, spawn = multiprocessing.Queue(2 * slices), multiprocessing.Event(), multiprocessing.Process
+    else:
+        buffer, stop, spawn = Queue(2 * slices), threading.Event(), threading.Thread
+    workers = []
+    for slice_id in xrange(slices):
+        # elasticsearch rejects a slice max of 1
+        slice_body = dict(body, slice={"id": slice_id, "max": slices}) if slices > 1 else body
+        worker = spawn(target=_read_slice, args=(connection, indices, doc_types, slice_body, page_size, buffer,
+                                                 stop, processes))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    try:
+        running = slices
+        while running:
+            kind, payload = buffer.get()
+            if kind == "chunk":
+                for document in payload:
+                    yield document
+            elif kind == "done":
+                running -= 1
+            elif isinstance(payload, tuple):
+                raise payload[0], payload[1], payload[2]
+            else:
+                raise RuntimeError("Reading a scroll slice failed:\n%s" % payload)
+    finally:
+        stop.set()
+        if processes:
+            # Worker processes only exit once what they queued is read
+            while any(worker.is_alive() for worker in workers):
+                try:
+                    buffer.get(timeout=PREFETCH_POLL_INTERVAL)
+                except Empty:
+                    pass
+
+
+def source_filter(fields):
+    """
+    Turn pymongo style ``fields`` into a ``_source`` filter. A list names the
+    fields to include, a dict maps field names to 1 (include) or 0 (exclude).
+    Returns None when the whole document is wanted.
+    """
+    if fields is None:
+        return None
+    if not isinstance(fields, dict):
+        return list(fields) or False
+    includes = [name for name, wanted in fields.items() if wanted]
+    excludes = [name for name, wanted in fields.items() if not wanted]
+    if includes:
+        return includes
+    return {"excludes": excludes}
+
+
+def hit_to_document(hit):
+    document = hit.get("_source") or {}
+    for name, values in hit.get("fields", {}).items():
+        document[name] = values[0] if len(values) == 1 else values
+    document["_id"] = hit["_id"]
+    return document
+
+
+class Cursor(object):
+    """
+    The subset of a pymongo cursor the QuerySet relies on, answered by
+    elasticsearch searches.
+    """
+
+    def __init__(self, collection, spec=None, fields=None):
+        self._collection = collection
+        self._spec = spec if spec is not None else {}
+        self._fields = fields
+        self._docvalue_fields = None
+        self._where = None
+        self._sort = []
+        self._search_after = None
+        self._last_sort = None
+        self._skip = 0
+        self._limit = None
+        self._batch_size = SCROLL_PAGE_SIZE
+
+    def clone(self):
+        cursor = copy.copy(self)
+        cursor._spec = dict(self._spec)
+        cursor._sort = list(self._sort)
+        return cursor
+
+    def where(self, clause):
+        self._where = clause
+        return self
+
+    def after(self, sort_values):
+        """
+        Page with search_after, starting after the hit with ``sort_values``
+        or at the start for an empty list. The sort gets a tiebreaker on
+        the document id so every position is unique.
+        """
+        self._search_after = list(sort_values)
+        return self
+
+    def sort(self, key_or_list, direction=1):
+        if not isinstance(key_or_list, (list, tuple)):
+            key_or_list = [(key_or_list, direction)]
+        self._sort = [{key: "desc" if direction < 0 else "asc"} for key, direction in key_or_list]
+        return self
+
+    def select(self, fields, docvalues=False):
+        """
+        Fetch only ``fields``. With ``docvalues`` they are read from doc
+        values and ``_source`` is not transferred at all.
+        """
+        if docvalues:
+            self._fields, self._docvalue_fields = [], list(fields)
+        else:
+            self._fields, self._docvalue_fields = fields, None
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def skip(self, n):
+        self._skip = n or 0
+        return self
+
+    def batch_size(self, n):
+        self._batch_size = n
+        return self
+
+    def query(self):
+        collection = self._collection
+        return optimize(spec_to_query(self._spec, self._where), collection.multi_valued, collection.keywords)
+
+    def body(self):
+        body = {"query": self.query()}
+        sort = self._sort
+        if self._search_after is not None:
+            if not any(TIEBREAKER in key for key in sort):
+                sort = sort + [{TIEBREAKER: "asc"}]
+            if self._search_after:
+                body["search_after"] = self._search_after
+        if sort:
+            body["sort"] = sort
+        source = source_filter(self._fields)
+        if source is not None:
+            body["_source"] = source
+        if self._docvalue_fields:
+            body["docvalue_fields"] = self._docvalue_fields
+        return body
+
+    def count(self, with_limit_and_skip=False):
+        collection = self._collection
+        query = self.query()
+        if query == MATCH_NONE:
+            return 0
+        collection.connection.flush_write_buffer()
+        result = collection.es.count({"query": query}, indices=[collection.index],
+                                     doc_types=[collection.doc_type])
+        count = result["count"]
+        if with_limit_and_skip:
+            count = max(count - self._skip, 0)
+            if self._limit is not None:
+                count = min(count, self._limit)
+        return count
+
+    def distinct(self, key):
+        collection = self._collection
+        query = self.query()
+        if query == MATCH_NONE:
+            return iter([])
+        return distinct_values(collection.es, [collection.index], [collection.doc_type], query, key)
+
+    def explain(self):
+        """The search body, and the query before and after optimize()."""
+        return {"before": spec_to_query(self._spec, self._where), "after": self.query(), "body": self.body()}
+
+    def __iter__(self):
+        # The index and body are resolved now, in the calling thread: the
+        # tenant they depend on is local to it
+        collection = self._collection
+        hits = iter_hits(collection.connection, [collection.index], [collection.doc_type], self.body(),
+                         skip=self._skip, limit=self._limit, page_size=self._batch_size,
+                         keyset=self._search_after is not None)
+        return self._documents(hits)
+
+    def _documents(self, hits):
+        for hit in hits:
+            self._last_sort = hit.get("sort")
+            yield hit_to_document(hit)
+
+    def chunks(self, chunk_size=None, prefetch=0):
+        """
+        The documents in lists of ``chunk_size``, one search page each. With
+        ``prefetch``, up to that many following pages are fetched and
+        decoded on a worker thread while the caller handles the current one.
+        """
+        cursor = self.clone()
+        if chunk_size:
+            cursor._batch_size = chunk_size
+        chunks = chunked(iter(cursor), cursor._batch_size)
+        if prefetch:
+            chunks = prefetched(chunks, prefetch)
+        return chunks
+
+    def parallel(self, workers, processes=False):
+        """
+        Iterate over the documents with a sliced scroll of ``workers``
+        slices read concurrently, in no particular order. A limit stops the
+        iteration once reached, skipping is not supported.
+        """
+        if self._skip:
+            raise ValueError("Sliced scrolls cannot skip documents")
+        collection = self._collection
+        body = self.body()
+        body.pop("sort", None)
+        body.pop("search_after", None)
+        documents = iter_slices(collection.connection, [collection.index], [collection.doc_type], body, workers,
+                                page_size=self._batch_size, processes=processes)
+        if self._limit is not None:
+            documents = islice(documents, self._limit)
+        return documents
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None or (key.start or 0) < 0 or (key.stop is not None and key.stop < 0):
+                raise IndexError("Cursor only supports non negative slices without step")
+            cursor = self.clone()
+            start = key.start or 0
+            cursor._skip = self._skip + start
+            if key.stop is not None:
+                cursor._limit = key.stop - start
+                if self._limit is not None:
+                    cursor._limit = min(cursor._limit, self._limit - start)
+            elif self._limit is not None:
+                cursor._limit = self._limit - start
+            if cursor._limit is not None and cursor._limit <= 0:
+                raise IndexError("Empty slice")
+            return cursor
+        cursor = self.clone()
+        cursor._skip = self._skip + key
+        cursor._limit = 1
+        for document in cursor:
+            return document
+        raise IndexError("No such item for Cursor instance")
+
+
+class Collection(object):
+    """
+    The documents of one model: a doc type inside the index of an
+    elasticsearch database connection.
+    """
+
+    def __init__(self, connection, doc_type, model=None):
+        self.connection = connection
+        self.doc_type = doc_type
+        self.model = model
+        # Fields range folding must leave alone, unknown without a model
+        self.multi_valued = multi_valued_fields(model)
+        # Fields whose string bounds can be folded
+        self.keywords = keyword_fields(model)
+
+    @property
+    def es(self):
+        return self.connection.db_connection
+
+    @property
+    def index(self):
+        return model_indices(self.connection.db_name, self.model)[0]
+
+    def find(self, spec=None, fields=None):
+        return Cursor(self, spec, fields)
+
+    def find_one(self, spec=None):
+        for document in self.find(spec).limit(1):
+            return document
+        return None
+
+    def remove(self, spec=None, safe=False):
+        query = optimize(spec_to_query(spec or {}), self.multi_valued, self.keywords)
+        if query != MATCH_NONE:
+            self.connection.flush_write_buffer()
+            delete_by_query(self.es, [self.index], [self.doc_type], query)
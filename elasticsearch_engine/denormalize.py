@@ -0,0 +1,169 @@
+import atexit
+import logging
+import threading
+import time
+from Queue import Queue, Empty
+
+from django.db import connections
+from django.db.models import ForeignKey, signals
+from django.db.models.fields.related import add_lazy_relation
+
+from .partition import model_indices
+from .tenancy import get_tenant, tenant
+
+__doc__ = "Related objects copied into the documents that point to them"
+
+logger = logging.getLogger(__name__)
+
+# Depth model_to_mapping maps a model with; foreign keys of the model are
+# embedded at this depth minus one
+MAPPING_DEPTH = 1
+
+# Seconds between two refresh batches of stale embedded copies
+REFRESH_INTERVAL = 5
+
+# Updates sent in one update_by_query request
+REFRESH_BATCH_SIZE = 500
+
+# Related model -> [(parent model, foreign key)] for denormalized foreign keys
+_EMBEDDED_IN = {}
+
+_REFRESH_SCRIPT = (
+    "def doc = params.docs[String.valueOf(ctx._source[params.field][params.pk])];"
+    "if (doc != null) { ctx._source[params.field] = doc }"
+)
+
+
+def denormalized_fields(model):
+    """The foreign keys of ``model`` whose targets are copied into its documents."""
+    option = getattr(getattr(model, "ESMeta", None), "denormalize", False)
+    if not option:
+        return []
+    return [field for field in model._meta.fields
+            if isinstance(field, ForeignKey) and (option is True or field.name in option)]
+
+
+def embed_related(instance, depth=MAPPING_DEPTH - 1):
+    """
+    The document of ``instance`` as model_to_mapping(type(instance), depth)
+    maps it: its fields, and its foreign keys as embedded objects while
+    depth allows or as primary keys past it.
+    """
+    document = {}
+    for field in instance._meta.fields:
+        value = getattr(instance, field.attname)
+        document[field.attname] = value
+        if isinstance(field, ForeignKey) and value is not None:
+            if depth >= 0:
+                document[field.name] = embed_related(getattr(instance, field.name), depth - 1)
+            else:
+                document[field.name] = value
+    return document
+
+
+def add_related_documents(model, data, instance=None):
+    """
+    Copy the targets of the denormalized foreign keys of ``model`` into the
+    document ``data`` about to be indexed. The instance's related object
+    cache is used when available.
+    """
+    for field in denormalized_fields(model):
+        pk = data.get(field.column)
+        if pk is None:
+            continue
+        related = instance is not None and getattr(instance, field.get_cache_name(), None)
+        if not related:
+            related = field.rel.to._default_manager.get(pk=pk)
+        data[field.name] = embed_related(related)
+
+
+class StaleCopyRefresher(object):
+    """
+    Collects related objects saved since the last batch and rewrites their
+    embedded copies from a background thread, with one update_by_query per
+    (parent model, foreign key) and batch.
+    """
+
+    def __init__(self, interval=REFRESH_INTERVAL, batch_size=REFRESH_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, model, pk, document):
+        """Refresh the copies of ``document`` in the index of the current tenant."""
+        self._queue.put((model, get_tenant(), pk, document))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="es-denormalize-refresh")
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Refreshing embedded copies failed")
+
+    def flush(self):
+        """Rewrite every embedded copy queued so far."""
+        changed = {}
+        while True:
+            try:
+                model, name, pk, document = self._queue.get_nowait()
+            except Empty:
+                break
+            # Only the last saved state of each object matters
+            changed.setdefault((model, name), {})[unicode(pk)] = document
+
+        for (model, name), documents in changed.items():
+            items = documents.items()
+            # The refresh thread has no tenant of its own
+            with tenant(name):
+                for start in xrange(0, len(items), self.batch_size):
+                    batch = dict(items[start:start + self.batch_size])
+                    for parent, field in _EMBEDDED_IN.get(model, []):
+                        self._refresh(parent, field, batch)
+
+    def _refresh(self, parent, field, documents):
+        connection = connections[parent._default_manager.db]
+        pk_attname = field.rel.to._meta.pk.attname
+        body = {
+            "query": {"terms": {"%s.%s" % (field.name, pk_attname): documents.keys()}},
+            "script": {"source": _REFRESH_SCRIPT, "lang": "painless",
+                       "params": {"field": field.name, "pk": pk_attname, "docs": documents}},
+        }
+        path = "/%s/%s/_update_by_query" % (",".join(model_indices(connection.db_name, parent)), parent._meta.db_table)
+        connection.db_connection._send_request('POST', path, body, params={"conflicts": "proceed"})
+
+
+refresher = StaleCopyRefresher()
+atexit.register(refresher.flush)
+
+
+def queue_stale_copies(sender, instance, **kwargs):
+    if sender in _EMBEDDED_IN:
+        refresher.enqueue(sender, instance.pk, embed_related(instance))
+
+
+def _track_related(field, related, model):
+    _EMBEDDED_IN.setdefault(related, []).append((model, field))
+    signals.post_save.connect(queue_stale_copies, sender=related, dispatch_uid="es-denormalize-%s" % id(related))
+
+
+def register_model(model):
+    """
+    Track the models ``model`` denormalizes so their saves refresh its
+    copies, once they are defined for foreign keys given by name.
+    """
+    for field in denormalized_fields(model):
+        if isinstance(field.rel.to, basestring):
+            add_lazy_relation(model, field, field.rel.to, _track_related)
+        else:
+            # Resolved already, maybe to ``model`` itself, which is not
+            # registered yet
+            _track_related(field, field.rel.to, model)
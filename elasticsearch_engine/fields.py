@@ -7,7 +7,7 @@ from django.db.models import CharField
 from django.db.models.fields import AutoField as DJAutoField
 
 
-__all__ = ["EmbeddedModel"]
+__all__ = ["EmbeddedModel", "EmbeddedModelField"]
 __doc__ = "ES special fields"
 
 
@@ -36,6 +36,68 @@ class EmbeddedModel(models.Model):
         return result
 
 
+class EmbeddedModelField(models.Field):
+    """
+    Stores an EmbeddedModel instance, or a list of them with ``many=True``,
+    as a plain object. The embedded model is declared here, so it is mapped
+    as an ``object`` (or ``nested`` with ``nested=True``) and stored
+    documents carry no _app/_model/_id/_type markers: values are rebuilt
+    from their place in the schema.
+    """
+
+    def __init__(self, embedded_model, many=False, nested=False, *args, **kwargs):
+        self.embedded_model = embedded_model
+        self.many = many
+        self.nested = nested
+        if many:
+            kwargs.setdefault("default", list)
+        super(EmbeddedModelField, self).__init__(*args, **kwargs)
+
+    def get_internal_type(self):
+        return "EmbeddedModelField"
+
+    def db_type(self, connection):
+        return "embedded"
+
+    def _to_document(self, instance, connection):
+        document = {}
+        for field in instance._meta.fields:
+            value = getattr(instance, field.attname)
+            if value is None:
+                continue
+            if isinstance(field, EmbeddedModelField):
+                value = field.get_db_prep_save(value, connection)
+            document[field.attname] = value
+        return document
+
+    def _from_document(self, document):
+        if not isinstance(document, dict):
+            # Instances decoded from documents written with type markers
+            return document
+        values = {}
+        for field in self.embedded_model._meta.fields:
+            if field.attname in document:
+                value = document[field.attname]
+                if isinstance(field, EmbeddedModelField):
+                    value = field.to_python(value)
+                values[str(field.attname)] = value
+        return self.embedded_model(**values)
+
+    def get_db_prep_save(self, value, connection):
+        if value is None:
+            return None
+        if self.many:
+            return [self._to_document(item, connection) for item in value]
+        return self._to_document(value, connection)
+
+    def to_python(self, value):
+        if value is None:
+            return None
+        if self.many:
+            return [self._from_document(item) for item in value]
+        return self._from_document(value)
+
+
 class ElasticField(CharField):
     def __init__(self, *args, **kwargs):
         self.doc_type = kwargs.pop("doc_type", None)
@@ -0,0 +1,223 @@
+import json
+import os
+import sys
+import threading
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min, get_model
+
+from elasticsearch_engine.bulk import document_routing, encode_action, index_action, instance_document, send_bulk
+from elasticsearch_engine.denormalize import denormalized_fields
+from elasticsearch_engine.partition import document_index
+from elasticsearch_engine.router import primary_database
+
+# Primary keys covered by one chunk, read, encoded and sent together
+REINDEX_CHUNK_SIZE = 1000
+
+
+def _init_worker():
+    # Forked workers must not share the parent's database sockets. The
+    # inherited SQL connections are dropped, not closed: closing them would
+    # send the driver's terminate message on the parent's socket.
+    for connection in connections.all():
+        if hasattr(connection, "reconnect"):
+            connection.reconnect()
+        else:
+            connection.connection = None
+
+
+def _encode_chunk(task):
+    """
+    Read the source rows with low <= pk < high and encode their index
+    actions. Errors are returned as text, so the chunk is reported failed.
+    """
+    label, source, target, low, high = task
+    try:
+        return low, high, _encode_rows(label, source, target, low, high), None
+    except Exception, e:
+        return low, high, None, unicode(e)
+
+
+def _encode_rows(label, source, target, low, high):
+    model = get_model(*label.split("."))
+    connection = connections[target]
+    queryset = model._default_manager.using(source).filter(pk__gte=low, pk__lt=high).order_by()
+    related = [field.name for field in denormalized_fields(model)]
+    if related:
+        queryset = queryset.select_related(*related)
+    db_name, doc_type = connection.settings_dict["NAME"], model._meta.db_table
+    encoded = []
+    for obj in queryset.iterator():
+        document = instance_document(obj, connection)
+        encoded.append(encode_action(index_action(document_index(db_name, model, document), doc_type, obj.pk,
+                                                  document, document_routing(model, document))))
+    return encoded
+
+
+class Checkpoint(object):
+    """
+    The primary key below which every chunk of each model is indexed,
+    kept in a JSON file so an interrupted reindex resumes there.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.positions = {}
+        if path and os.path.exists(path):
+            with open(path) as fp:
+                self.positions = json.load(fp)
+
+    def get(self, label):
+        return self.positions.get(label)
+
+    def set(self, label, position):
+        self.positions[label] = position
+        if self.path:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as fp:
+                json.dump(self.positions, fp)
+            os.rename(tmp, self.path)
+
+
+class Command(BaseCommand):
+    args = "<app_label.ModelName app_label.ModelName ...>"
+    help = ("Index the rows of SQL models into elasticsearch: pk range chunks are read and encoded by a "
+            "process pool and written through _bulk, resuming from a checkpoint file.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--source", default="default",
+                    help="Database alias the rows are read from. Defaults to 'default'."),
+        make_option("--database", default=None,
+                    help="Elasticsearch database alias written to. Defaults to ELASTICSEARCH_PRIMARY_DATABASE, "
+                         "or the only one in DATABASES."),
+        make_option("--chunk-size", type="int", default=REINDEX_CHUNK_SIZE,
+                    help="Primary keys per chunk and _bulk request."),
+        make_option("--workers", type="int", default=cpu_count(),
+                    help="Processes reading and encoding chunks."),
+        make_option("--concurrency", type="int", default=2,
+                    help="_bulk requests in flight."),
+        make_option("--checkpoint", default=None,
+                    help="JSON file recording progress; an interrupted run resumes from it."),
+    )
+
+    def handle(self, *labels, **options):
+        if not labels:
+            raise CommandError("Enter at least one app_label.ModelName.")
+        target = options["database"] or self._elasticsearch_database()
+        checkpoint = Checkpoint(options["checkpoint"])
+        for label in labels:
+            model = get_model(*label.split(".", 1)) if "." in label else None
+            if model is None:
+                raise CommandError("Unknown model: %s" % label)
+            self.reindex(model, label, options["source"], target, checkpoint, options)
+
+    def _elasticsearch_database(self):
+        try:
+            alias = primary_database()
+        except ImproperlyConfigured, e:
+            raise CommandError("%s, or use --database." % e)
+        if alias is not None:
+            return alias
+        raise CommandError("No elasticsearch database is configured, use --database.")
+
+    def reindex(self, model, label, source, target, checkpoint, options):
+        if model._meta.pk.get_internal_type() not in ("AutoField", "IntegerField", "BigIntegerField",
+                                                      "PositiveIntegerField"):
+            raise CommandError("%s needs an integer primary key to be read in pk ranges" % label)
+        bounds = model._default_manager.using(source).aggregate(low=Min("pk"), high=Max("pk"))
+        if bounds["low"] is None:
+            self.stdout.write("%s: no rows\n" % label)
+            return
+        start = checkpoint.get(label)
+        if start is None:
+            start = bounds["low"]
+        chunk_size = options["chunk_size"]
+        tasks = [(label, source, target, low, low + chunk_size)
+                 for low in xrange(start, bounds["high"] + 1, chunk_size)]
+        if not tasks:
+            self.stdout.write("%s: already indexed up to pk %s\n" % (label, start))
+            return
+
+        es = connections[target].db_connection
+        # Chunks finish out of order, the checkpoint only moves past contiguous ones
+        pending = deque(task[3] for task in tasks)
+        finished = set()
+        failures = []
+        # Errors of the pool callbacks, raised again by the main thread
+        errors = []
+        counts = {"documents": 0}
+        lock = threading.Lock()
+        # Chunks submitted and not sent yet: encoding, encoded or being sent
+        window = threading.BoundedSemaphore(options["workers"] + options["concurrency"] * 2)
+
+        def sent(result):
+            try:
+                low, count, chunk_failures = result
+                with lock:
+                    counts["documents"] += count
+                    if chunk_failures:
+                        # Left unfinished so a resumed run reads the chunk again
+                        failures.extend(chunk_failures)
+                    else:
+                        finished.add(low)
+                    while pending and pending[0] in finished:
+                        finished.discard(pending.popleft())
+                    checkpoint.set(label, pending[0] if pending else bounds["high"] + 1)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                window.release()
+
+        def send(low, encoded):
+            try:
+                return low, len(encoded), send_bulk(es, encoded) if encoded else []
+            except Exception, e:
+                return low, 0, [{"action": "index", "_id": None, "status": None,
+                                 "error": "chunk from pk %s: %s" % (low, e)}]
+
+        def encoded_chunk(result):
+            low, high, encoded, error = result
+            if error is not None:
+                sent((low, 0, [{"action": "index", "_id": None, "status": None,
+                                "error": "chunk from pk %s: %s" % (low, error)}]))
+                return
+            try:
+                senders.apply_async(send, (low, encoded), callback=sent)
+            except Exception:
+                errors.append(sys.exc_info())
+                window.release()
+
+        def raise_errors():
+            if errors:
+                exc_info = errors[0]
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+        encoders = Pool(options["workers"], initializer=_init_worker)
+        senders = ThreadPool(options["concurrency"])
+        try:
+            for task in tasks:
+                # Encoded chunks wait for the senders here, not in memory
+                window.acquire()
+                raise_errors()
+                encoders.apply_async(_encode_chunk, (task,), callback=encoded_chunk)
+            # Joining the encoders waits for their callbacks, which submit the last sends
+            encoders.close()
+            encoders.join()
+            senders.close()
+            senders.join()
+            raise_errors()
+        finally:
+            encoders.terminate()
+            senders.terminate()
+
+        self.stdout.write("%s: %d documents sent, %d failed\n" % (label, counts["documents"], len(failures)))
+        if failures:
+            for failure in failures[:10]:
+                self.stderr.write("  %s %s: %s\n" % (failure["action"], failure["_id"], failure["error"]))
+            raise CommandError("%d documents of %s were not indexed" % (len(failures), label))
@@ -3,9 +3,17 @@ from django.db.models.manager import Manager as DJManager
 from django.db.utils import DatabaseError
 from bson.objectid import ObjectId
 
+from array import array
 import re
 
-from .utils import dict_keys_to_str
+from .cursor import SCROLL_PAGE_SIZE, TIEBREAKER, Collection, decode_token, encode_token
+from .denormalize import denormalized_fields
+from .utils import get_hydrator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 try:
     from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
@@ -24,6 +32,23 @@ __all__ = ['queryset_manager', 'Q', 'InvalidQueryError',
 # The maximum number of items to display in a QuerySet.__repr__
 REPR_OUTPUT_SIZE = 20
 
+# Fields whose values can be read back from doc values unchanged
+DOCVALUE_FIELD_TYPES = ('IntegerField', 'SmallIntegerField', 'PositiveIntegerField', 'PositiveSmallIntegerField',
+                        'BigIntegerField', 'FloatField', 'BooleanField', 'NullBooleanField')
+
+# array.array typecodes used by QuerySet.to_arrays, other fields are kept in lists
+ARRAY_TYPECODES = {
+    'IntegerField': 'l',
+    'SmallIntegerField': 'l',
+    'PositiveIntegerField': 'l',
+    'PositiveSmallIntegerField': 'l',
+    'BigIntegerField': 'l',
+    'FloatField': 'd',
+    'DecimalField': 'd',
+    'BooleanField': 'B',
+    'NullBooleanField': 'B',
+}
+
 
 class InvalidQueryError(Exception):
     pass
@@ -67,9 +92,13 @@ class QuerySet(object):
         self._collection_obj = collection
         self._accessed_collection = False
         self._query = {}
+        self._q_obj = None
         self._where_clause = None
         self._loaded_fields = []
+        self._deferred_fields = []
+        self._select_related = ()
         self._ordering = []
+        self._search_after = None
         self.transform = None
 
         # If inheritance is allowed, only return instances and instances of
@@ -87,14 +116,16 @@ class QuerySet(object):
         """Filter the selected documents by calling the
         :class:`~mongoengine.queryset.QuerySet` with a query.
 
-        :param q_obj: a :class:`~mongoengine.queryset.Q` object to be used in
-            the query; the :class:`~mongoengine.queryset.QuerySet` is filtered
-            multiple times with different :class:`~mongoengine.queryset.Q`
-            objects, only the last one will be used
+        :param q_obj: a :class:`~elasticsearch_engine.query.Q` object to be
+            used in the query; when the :class:`QuerySet` is filtered multiple
+            times with different :class:`~elasticsearch_engine.query.Q`
+            objects, all of them must match
         :param query: Django-style query keyword arguments
         """
         if q_obj:
-            self._where_clause = q_obj.as_js(self._document)
+            self._q_obj = q_obj if self._q_obj is None else self._q_obj & q_obj
+            self._where_clause = self._q_obj.to_query(self._document)
+            self._cursor_obj = None
         query = QuerySet._transform_query(_doc_cls=self._document, **query)
         self._query.update(query)
         return self
@@ -112,7 +143,7 @@ class QuerySet(object):
         """An alias of :meth:`~mongoengine.queryset.QuerySet.__call__`
         """
         query["not"] = True
-        return self.__call__(*q_objs, **query)
+        return self.__call__(*[~q_obj for q_obj in q_objs], **query)
 
     def all(self):
         """An alias of :meth:`~mongoengine.queryset.QuerySet.__call__`
@@ -121,7 +152,8 @@ class QuerySet(object):
 
     def distinct(self, *args, **kwargs):
         """
-        Distinct method
+        Distinct values of a field, streamed from a terms or composite
+        aggregation without loading the documents.
         """
         return self._cursor.distinct(*args, **kwargs)
 
@@ -133,34 +165,113 @@ class QuerySet(object):
         return self._collection_obj
 
     def values(self, *args):
-        return (args and [dict(zip(args, [getattr(doc, key) for key in args])) for doc in self]) or [obj for obj in
-                                                                                                     self._cursor.clone()]
+        return (args and [dict(zip(args, row)) for row in self._iter_values(args)]) or list(self.as_dicts())
+
+    def as_dicts(self):
+        """Iterate over the decoded documents as plain dicts, without
+        building model instances.
+        """
+        return iter(self._cursor.clone())
+
+    def to_arrays(self, *fields, **kwargs):
+        """Load ``fields`` column by column. Returns a dict mapping each
+        field to an ``array.array`` for numeric and boolean fields, or to a
+        list for the others. When NumPy is installed the columns are NumPy
+        arrays instead. Numeric columns holding missing values become float
+        columns with NaN. Columns are filled one scroll page at a time. ::
+
+            frame = pandas.DataFrame(Event.objects(kind="click").to_arrays("count", "score"))
+
+        :param fields: the fields to load
+        :param batch_size: documents fetched per scroll page
+        """
+        batch_size = kwargs.pop("batch_size", None)
+        columns = []
+        for name in fields:
+            field = QuerySet._lookup_field(self._document, name)
+            typecode = ARRAY_TYPECODES.get(field.get_internal_type())
+            columns.append(array(typecode) if typecode else [])
+
+        nan = float('nan')
+        for row in self._iter_values(fields, batch_size=batch_size):
+            for i, value in enumerate(row):
+                column = columns[i]
+                if value is None and isinstance(column, array):
+                    if column.typecode != 'd':
+                        column = columns[i] = array('d', column)
+                    value = nan
+                column.append(value)
+
+        result = {}
+        for name, column in zip(fields, columns):
+            if numpy is not None:
+                if isinstance(column, array):
+                    dtype = numpy.bool_ if column.typecode == 'B' else column.typecode
+                    column = numpy.frombuffer(column, dtype=dtype)
+                else:
+                    column = numpy.array(column, dtype=object)
+            result[name] = column
+        return result
 
     def values_list(self, *args, **kwargs):
         flat = kwargs.pop("flat", False)
         if flat and len(args) != 1:
             raise Exception("args len must be 1 when flat=True")
 
-        return (flat and self.distinct(args[0] if not args[0] in ["id", "pk"] else "_id")) or zip(
-            *[self.distinct(field if field not in ["id", "pk"] else "_id") for field in args])
+        return (flat and self.distinct(args[0] if not args[0] in ["id", "pk"] else "_id")) or list(
+            self._iter_values(args))
+
+    def _iter_values(self, fields, batch_size=None):
+        """
+        Yield a tuple of ``fields`` per document, transferring only those
+        fields. Numeric and boolean fields are read from doc values.
+        """
+        pk = self._document._meta.pk.attname
+        keys = []
+        docvalues = True
+        for name in fields:
+            field = QuerySet._lookup_field(self._document, name)
+            keys.append(field.attname == pk and "_id" or field.attname)
+            if field.attname != pk and field.get_internal_type() not in DOCVALUE_FIELD_TYPES:
+                docvalues = False
+        selected = [key for key in keys if key != "_id"]
+        cursor = self._cursor.clone().select(selected, docvalues=docvalues and bool(selected))
+        if batch_size:
+            cursor.batch_size(batch_size)
+        for doc in cursor:
+            yield tuple(doc.get(key) for key in keys)
 
     @property
     def _cursor(self):
         if self._cursor_obj is None:
             cursor_args = {}
-            if self._loaded_fields:
-                cursor_args = {'fields': self._loaded_fields}
+            if self._loaded_fields or self._deferred_fields:
+                fields = dict((field, 1) for field in self._loaded_fields)
+                if self._loaded_fields:
+                    fields.update((name, 1) for name in self._related_names())
+                fields.update((field, 0) for field in self._deferred_fields if field not in fields)
+                cursor_args = {'fields': fields}
             self._cursor_obj = self._collection.find(self._query,
                                                      **cursor_args)
             # Apply where clauses to cursor
             if self._where_clause:
                 self._cursor_obj.where(self._where_clause)
+            if self._ordering:
+                self._cursor_obj.sort(self._ordering)
+            if self._search_after is not None:
+                self._cursor_obj.after(self._search_after)
+            # Kept across only(), defer() and select_related(), which
+            # rebuild the cursor
+            if self._skip:
+                self._cursor_obj.skip(self._skip)
+            if self._limit is not None:
+                self._cursor_obj.limit(self._limit or 1)
 
                 # apply default ordering
                 # if self._document._meta['ordering']:
                 # self.order_by(*self._document._meta['ordering'])
 
-        return self._cursor_obj.clone()
+        return self._cursor_obj
 
     @classmethod
     def _lookup_field(cls, document, fields):
@@ -313,7 +424,7 @@ class QuerySet(object):
         result = self._collection.find_one(
             {'_id': (not isinstance(object_id, ObjectId) and ObjectId(object_id)) or object_id})
         if result is not None:
-            result = self._document(**dict_keys_to_str(result))
+            result = self._hydrator()(result)
         return result
 
     def in_bulk(self, object_ids):
@@ -329,8 +440,10 @@ class QuerySet(object):
 
         docs = self._collection.find(
             {'_id': {'$in': [(not isinstance(id, ObjectId) and ObjectId(id)) or id for id in object_ids]}})
+        hydrate = self._hydrator()
         for doc in docs:
-            doc_map[str(doc['id'])] = self._document(**dict_keys_to_str(doc))
+            obj = hydrate(doc)
+            doc_map[str(obj.pk)] = obj
 
         return doc_map
 
@@ -376,7 +489,7 @@ class QuerySet(object):
         if isinstance(key, slice):
             try:
                 self._cursor_obj = self._cursor[key]
-                self._skip, self._limit = key.start, key.stop
+                self._skip, self._limit = self._cursor_obj._skip, self._cursor_obj._limit
             except IndexError, err:
                 # PyMongo raises an error if key.start == key.stop, catch it,
                 # bin it, kill it.
@@ -391,7 +504,7 @@ class QuerySet(object):
             return self
         # Integer index provided
         elif isinstance(key, int):
-            return self._document(**dict_keys_to_str(self._cursor[key]))
+            return self._hydrator()(self._cursor[key])
 
     def only(self, *fields):
         """Load only a subset of this document's fields. ::
@@ -408,14 +521,48 @@ class QuerySet(object):
                 raise InvalidQueryError('Subfields cannot be used as '
                                         'arguments to QuerySet.only')
             # Translate field name
-            field = QuerySet._lookup_field(self._document, field)[-1].db_field
+            field = QuerySet._lookup_field(self._document, field).attname
             self._loaded_fields.append(field)
+        self._cursor_obj = None
+        return self
+
+    def defer(self, *fields):
+        """Load every field of this document except ``fields``, which are
+        excluded from the ``_source`` returned by elasticsearch. ::
 
-        # _cls is needed for polymorphism
-        if self._document._meta.get('allow_inheritance'):
-            self._loaded_fields += ['_cls']
+            post = BlogPost.objects(...).defer("body")
+
+        :param fields: fields to leave out
+        """
+        for field in fields:
+            if '.' in field:
+                raise InvalidQueryError('Subfields cannot be used as '
+                                        'arguments to QuerySet.defer')
+            field = QuerySet._lookup_field(self._document, field).attname
+            self._deferred_fields.append(field)
+        self._cursor_obj = None
         return self
 
+    def select_related(self, *fields):
+        """Attach the related objects embedded in the documents by
+        ``ESMeta.denormalize``, without further requests. ::
+
+            post = BlogPost.objects(...).select_related("author")
+
+        :param fields: foreign keys to attach, every denormalized one by default
+        """
+        self._select_related = fields or True
+        self._cursor_obj = None
+        return self
+
+    def _related_names(self):
+        if not self._select_related:
+            return []
+        names = [field.name for field in denormalized_fields(self._document)]
+        if self._select_related is True:
+            return names
+        return [name for name in self._select_related if name in names]
+
     def order_by(self, *args):
         """
             Order the :class:`~mongoengine.queryset.QuerySet` by the keys. The
@@ -428,11 +575,47 @@ class QuerySet(object):
 
         self._ordering = []
         for col in args:
-            self._ordering.append(((col.startswith("-") and col[1:]) or col, (col.startswith("-") and -1) or 1))
+            name = col.lstrip("+-")
+            if name == "pk" or name == self._document._meta.pk.name:
+                name = TIEBREAKER
+            else:
+                name = QuerySet._lookup_field(self._document, name).attname
+            self._ordering.append((name, (col.startswith("-") and -1) or 1))
 
         self._cursor.sort(self._ordering)
         return self
 
+    def after(self, token=None):
+        """Page through the ordered results with ``search_after``, starting
+        after the position ``token`` was taken at, or at the start. Every
+        page costs the same however deep it is. ::
+
+            events = Event.objects.order_by("created").after(token)[:50]
+            page = list(events)
+            token = events.cursor_token()
+
+        The ordering is completed with the document id, so that each
+        position, and the token for it, is unique.
+
+        :param token: a token returned by :meth:`cursor_token`
+        """
+        try:
+            self._search_after = decode_token(token) if token is not None else []
+        except ValueError, e:
+            raise InvalidQueryError(str(e))
+        self._cursor.after(self._search_after)
+        return self
+
+    def cursor_token(self):
+        """The opaque token of the position after the last result read, to
+        be passed to :meth:`after` for the next page; None before any result
+        of a keyset paginated query was read.
+        """
+        sort_values = self._cursor._last_sort
+        if self._search_after is None or sort_values is None:
+            return None
+        return encode_token(sort_values)
+
     def explain(self, format=False):
         """Return an explain plan record for the
         :class:`~mongoengine.queryset.QuerySet`\ 's cursor.
@@ -509,12 +692,51 @@ class QuerySet(object):
     def update_one(self, safe_update=True, upsert=False, **update):
         pass
 
+    def _hydrator(self):
+        return get_hydrator(self._document, self._collection.connection.alias, self._related_names())
+
     def __iter__(self, *args, **kwargs):
+        hydrate = self._hydrator()
         for obj in self._cursor:
-            data = dict_keys_to_str(obj)
-            if '_id' in data:
-                data['id'] = data.pop('_id')
-            yield self._document(**data)
+            yield hydrate(obj)
+
+    def iterator(self, chunk_size=SCROLL_PAGE_SIZE, prefetch=1):
+        """Iterate over the results one page of ``chunk_size`` at a time,
+        with the next ``prefetch`` pages fetched on a worker thread while
+        the current one is handled. The buffer between both is bounded, so
+        a slow consumer holds back the fetching. ::
+
+            for event in Event.objects(kind="click").iterator(chunk_size=2000):
+                export(event)
+
+        :param chunk_size: documents per search page
+        :param prefetch: pages fetched ahead, 0 to fetch them in the caller
+        """
+        hydrate = self._hydrator()
+        for chunk in self._cursor.chunks(chunk_size, prefetch):
+            for obj in chunk:
+                yield hydrate(obj)
+
+    def parallel_iter(self, workers=4, processes=False):
+        """Iterate over the results with a sliced scroll: each of the
+        ``workers`` slices is fetched and decoded by its own thread, or by
+        its own process with ``processes`` for CPU heavy decoding, and the
+        results come in no particular order. ::
+
+            for event in Event.objects.parallel_iter(workers=8):
+                export(event)
+
+        :param workers: number of slices read concurrently, best set to
+            the number of shards
+        :param processes: decode in worker processes instead of threads
+        """
+        try:
+            documents = self._cursor.parallel(workers, processes)
+        except ValueError, e:
+            raise InvalidQueryError(str(e))
+        hydrate = self._hydrator()
+        for obj in documents:
+            yield hydrate(obj)
 
     def _sub_js_fields(self, code):
         """When fields are specified with [~fieldname] syntax, where
@@ -549,7 +771,6 @@ class Manager(DJManager):
     def __init__(self, manager_func=None):
         super(Manager, self).__init__()
         self._manager_func = manager_func
-        self._collection = None
 
     def contribute_to_class(self, model, name):
         # TODO: Use weakref because of possible memory leak / circular reference.
@@ -573,11 +794,12 @@ class Manager(DJManager):
             # Document class being used rather than a document object
             return self
 
-        if self._collection is None:
-            self._collection = connections[self.db].db_connection[owner._meta.db_table]
+        # Not kept: the router picks the read database of each QuerySet,
+        # and connections are per thread
+        collection = Collection(connections[self.db], owner._meta.db_table, owner)
 
         # owner is the document that contains the QuerySetManager
-        queryset = QuerySet(owner, self._collection)
+        queryset = QuerySet(owner, collection)
         if self._manager_func:
             if self._manager_func.func_code.co_argcount == 1:
                 queryset = self._manager_func(queryset)
@@ -1,90 +1,211 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import copy
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import ForeignKey
 from pyes import mappings
 
+from .models import ESMeta
+
+# Generated mappings keyed by (model, depth)
+_MAPPINGS = {}
+
 
 def model_to_mapping(model, depth=1):
     """
-    Given a model return a mapping
+    Given a model return a mapping. Mappings are generated once per
+    (model, depth) and shared, so callers must not modify them.
     """
+    key = (model, depth)
+    if key not in _MAPPINGS:
+        _MAPPINGS[key] = _build_mapping(model, depth)
+    return _MAPPINGS[key]
+
+
+def _build_mapping(model, depth):
     meta = model._meta
+    es_meta = getattr(model, "ESMeta", ESMeta)
+    model_profile = getattr(es_meta, "mapping_profile", None)
+    field_profiles = getattr(es_meta, "field_profiles", {})
     indexoptions = getattr(model, "indexeroptions", {})
     ignore = indexoptions.get("ignore", [])
     fields_options = indexoptions.get("fields", {})
     extra_fields = indexoptions.get("extra_fields", {})
-    mapper = mappings.ObjectField(meta.module_name)
+    dynamic = getattr(es_meta, "dynamic", None)
+    mapper = mappings.ObjectField(meta.module_name, dynamic=dynamic)
 
     for field in meta.fields + meta.many_to_many:
         name = field.name
-        if name in ignore:
-            continue
-        map_data = get_mapping_for_field(field, depth=depth, **fields_options.get(name, {}))
+        options = dict(fields_options.get(name, {}))
+        options.setdefault("profile", field_profiles.get(name, model_profile))
+        map_data = None if name in ignore else get_mapping_for_field(field, depth=depth, **options)
         if map_data:
             mapper.add_property(map_data)
+        elif dynamic == "strict" and field in meta.fields:
+            # Documents hold every column, a strict mapping would reject them all
+            raise ImproperlyConfigured("%s.%s has no mapping, which the strict mapping of %s needs"
+                                       % (meta.object_name, name, meta.object_name))
+        if name in ignore:
+            continue
+        if isinstance(field, ForeignKey):
+            # Documents hold the key of the related object in its column,
+            # which a strict mapping must know about
+            column_data = get_mapping_for_field(field.rel.to._meta.pk, depth=-1, profile=options["profile"])
+            if column_data:
+                column_data.name = field.column
+                mapper.add_property(column_data)
 
     for name, options in extra_fields.items():
+        options = dict(options)
         type = options.pop("type", "string")
         if type == "string":
-            data = dict(name=name, store=True, index="analyzed", term_vector="with_positions_offsets")
-            data.update(options)
-
-            if data['index'] == 'not_analyzed':
-                del data['term_vector']
-
-            mapper.add_property(mappings.StringField(**data))
+            profile = options.pop("profile", None) or model_profile or "search"
+            mapper.add_property(_field_mapping(name, "string", profile, options))
             continue
 
     return mapper
 
 
-def get_mapping_for_field(field, depth=1, **options):
-    """Given a field returns a mapping"""
+class MappedField(object):
+    """A field mapping given as a plain dict."""
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def as_dict(self):
+        return self.data
+
+
+# Settings each mapping profile gives to string fields, type included,
+# and to the other field types. Nothing is stored outside _source unless
+# asked for.
+PROFILES = {
+    # exact matches, filters and terms lookups
+    "keyword": ({"type": "keyword"}, {}),
+    # full text search only
+    "search": ({"type": "text"}, {}),
+    # sorting and aggregations, read from doc values
+    "sortable": ({"type": "keyword", "doc_values": True}, {"doc_values": True}),
+    # kept in _source only
+    "not_indexed": ({"type": "keyword", "index": False, "doc_values": False}, {"index": False, "doc_values": False}),
+    # stored, plus an analyzed "tk" sub field with term vectors for strings
+    "full": (None, {"store": True}),
+}
+
+STRING_FIELDS = ["SlugField", "EmailField", "TagField", "URLField", "CharField", "ImageField", "FileField",
+                 "FilePathField", "IPAddressField", "GenericIPAddressField", "CommaSeparatedIntegerField", ]
+
+FIELD_TYPES = {
+    "AutoField": "string",
+    "IntegerField": "integer",
+    "PositiveSmallIntegerField": "integer",
+    "SmallIntegerField": "integer",
+    "PositiveIntegerField": "integer",
+    "BigIntegerField": "long",
+    "PositionField": "integer",
+    "FloatField": "double",
+    "DecimalField": "double",
+    "BooleanField": "boolean",
+    "NullBooleanField": "boolean",
+    "DateField": "date",
+    "DateTimeField": "date",
+    # stored as a datetime on 2000-01-01
+    "TimeField": "date",
+    "CreationDateTimeField": "date",
+    "ModificationDateTimeField": "date",
+    "AddedDateTimeField": "date",
+    "ModifiedDateTimeField": "date",
+}
+
+
+def _full_string_mapping(name, analyzed_only, options):
+    if not analyzed_only:
+        return MappedField(name, {
+            "type": "keyword", "store": True,
+            "fields": {"tk": {"type": "text", "store": True, "term_vector": "with_positions_offsets"}},
+        })
+
+    data = {"type": "text", "store": True, "term_vector": "with_positions_offsets"}
+    data.update(options)
+    if data["type"] == "keyword":
+        del data["term_vector"]
+    return MappedField(name, data)
+
+
+def _field_mapping(name, es_type, profile, options, analyzed_only=False):
+    """
+    The mapping of a field of ``es_type``; "string" fields become keyword
+    or text as ``profile`` says.
+    """
+    if profile not in PROFILES:
+        raise ValueError("Unknown mapping profile %r for %s" % (profile, name))
+    string_settings, other_settings = PROFILES[profile]
+    if es_type == "string":
+        if string_settings is None:
+            return _full_string_mapping(name, analyzed_only, options)
+        data = dict(string_settings)
+    else:
+        data = dict(other_settings)
+        data["type"] = es_type
+    data.update(options)
+    return MappedField(name, data)
+
+
+def get_mapping_for_field(field, depth=1, profile=None, **options):
+    """
+    Given a field returns a mapping. ``profile`` picks one of PROFILES,
+    strings default to "keyword" and text to "search".
+    """
     ntype = type(field).__name__
-    if ntype in ["AutoField"]:
-        return mappings.StringField(name=field.name, store=True)
-    elif ntype in ["IntegerField", "PositiveSmallIntegerField", "SmallIntegerField", "PositiveIntegerField",
-                   "PositionField"]:
-        return mappings.IntegerField(name=field.name, store=True)
-    elif ntype in ["FloatField", "DecimalField"]:
-        return mappings.DoubleField(name=field.name, store=True)
-    elif ntype in ["BooleanField", "NullBooleanField"]:
-        return mappings.BooleanField(name=field.name, store=True)
-    elif ntype in ["DateField", "DateTimeField", "CreationDateTimeField", "ModificationDateTimeField",
-                   "AddedDateTimeField", "ModifiedDateTimeField"]:
-        return mappings.DateField(name=field.name, store=True)
-    elif ntype in ["SlugField", "EmailField", "TagField", "URLField", "CharField", "ImageField", "FileField", ]:
-        fields = {
-            field.name: mappings.StringField(name=field.name, index="not_analyzed", store=True),
-            "tk": mappings.StringField(name="tk", store=True, index="analyzed", term_vector="with_positions_offsets")
-        }
-        return mappings.MultiField(name=field.name,
-                                   fields=fields)
+    if ntype in FIELD_TYPES:
+        return _field_mapping(field.name, FIELD_TYPES[ntype], profile or "keyword", options)
+    elif ntype in STRING_FIELDS:
+        return _field_mapping(field.name, "string", profile or "keyword", options)
     elif ntype in ["TextField"]:
-        data = dict(name=field.name, store=True, index="analyzed", term_vector="with_positions_offsets")
-
-        if field.unique:
-            data['index'] = 'not_analyzed'
-
-        data.update(options)
-
-        if data['index'] == 'not_analyzed':
-            del data['term_vector']
+        if not profile:
+            profile = "keyword" if field.unique else "search"
+        if profile == "full" and field.unique:
+            options.setdefault("type", "keyword")
+        return _field_mapping(field.name, "string", profile, options, analyzed_only=True)
 
-        return mappings.StringField(**data)
-
-    elif ntype in ["ForeignKey", "TaggableManager", "GenericRelation"]:
+    elif ntype in ["ForeignKey", "OneToOneField", "TaggableManager", "GenericRelation"]:
         if depth >= 0:
-            mapper = model_to_mapping(field.rel.to, depth - 1)
+            mapper = copy.copy(model_to_mapping(field.rel.to, depth - 1))
             if mapper:
                 mapper.name = field.name
                 return mapper
             return None
-        return get_mapping_for_field(field.rel.to._meta.pk, depth - 1)
+        mapper = get_mapping_for_field(field.rel.to._meta.pk, depth - 1)
+        if mapper:
+            mapper.name = field.name
+        return mapper
+
+    elif ntype in ["EmbeddedModelField"]:
+        mapper = copy.copy(model_to_mapping(field.embedded_model, depth))
+        mapper.name = field.name
+        if field.nested:
+            mapper.type = "nested"
+        return mapper
+
+    elif ntype in ["ListField", "SetField"]:
+        # Arrays are mapped as their items, foreign keys by their key
+        item_depth = -1 if isinstance(field.item_field, ForeignKey) else depth
+        mapper = get_mapping_for_field(field.item_field, item_depth, profile, **options)
+        if mapper:
+            mapper = copy.copy(mapper)
+            mapper.name = field.name
+        return mapper
+
+    elif ntype in ["DictField"]:
+        # Any keys, even under a strict mapping
+        return MappedField(field.name, {"type": "object", "dynamic": True})
 
     elif ntype in ["ManyToManyField"]:
         if depth > 0:
-            mapper = model_to_mapping(field.rel.to, depth - 1)
+            mapper = copy.copy(model_to_mapping(field.rel.to, depth - 1))
             mapper.name = field.name
             return mapper
         if depth == 0:
@@ -97,3 +218,36 @@ def get_mapping_for_field(field, depth=1, **options):
             return None
 
     return None
+
+
+def _same_value(live, wanted):
+    # elasticsearch echoes booleans back as strings and pyes writes
+    # store as "yes"/"no"
+    aliases = {"yes": "true", "no": "false"}
+    live, wanted = unicode(live).lower(), unicode(wanted).lower()
+    return aliases.get(live, live) == aliases.get(wanted, wanted)
+
+
+def mapping_is_current(live, wanted):
+    """
+    Tell whether the live mapping already holds everything in the wanted
+    one. Settings elasticsearch adds on its own are ignored.
+    """
+    if isinstance(wanted, dict):
+        if not isinstance(live, dict):
+            return False
+        for key, value in wanted.items():
+            if key not in live:
+                # object is the implied type of fields with properties
+                if key == "type" and value == "object" and "properties" in live:
+                    continue
+                if key == "properties" and not value:
+                    continue
+                return False
+            if not mapping_is_current(live[key], value):
+                return False
+        return True
+    if isinstance(wanted, (list, tuple)):
+        return isinstance(live, (list, tuple)) and len(live) == len(wanted) and \
+            all(mapping_is_current(l, w) for l, w in zip(live, wanted))
+    return _same_value(live, wanted)
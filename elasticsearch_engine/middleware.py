@@ -0,0 +1,66 @@
+import sys
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_by_path
+
+from .tenancy import set_tenant
+
+
+class WriteBufferMiddleware(object):
+    """
+    Buffer the writes each request makes to the elasticsearch databases and
+    send them in _bulk batches when the response is ready, so a view saving
+    many objects makes one write request instead of one per object.
+    Failed actions raise BulkError from process_response.
+
+    Searches, counts and deletes by query made through the ORM or the
+    manager's collections send the buffered writes first, so they see
+    the objects the request created. Requests made with the pyes client
+    directly don't: they only see the writes sent so far.
+    """
+
+    def process_request(self, request):
+        request._es_write_buffers = []
+        for connection in connections.all():
+            if hasattr(connection, "write_buffer"):
+                scope = connection.write_buffer()
+                scope.__enter__()
+                request._es_write_buffers.append(scope)
+
+    def _close(self, request, exc_info):
+        scopes = getattr(request, "_es_write_buffers", [])
+        request._es_write_buffers = []
+        for scope in reversed(scopes):
+            scope.__exit__(*exc_info)
+
+    def process_exception(self, request, exception):
+        # Sent anyway, elasticsearch has no transaction to roll back
+        self._close(request, (type(exception), exception, sys.exc_info()[2]))
+        return None
+
+    def process_response(self, request, response):
+        self._close(request, (None, None, None))
+        return response
+
+
+class TenantMiddleware(object):
+    """
+    Make each request's tenant the one elasticsearch queries and writes
+    are for. ELASTICSEARCH_TENANT_RESOLVER is the dotted path of a
+    function returning the tenant of a request; by default it is
+    ``request.tenant``, set by an earlier middleware. Requests it resolves
+    to no tenant can't use multi-tenant databases, they raise
+    TenantRequired.
+    """
+
+    def __init__(self):
+        path = getattr(settings, "ELASTICSEARCH_TENANT_RESOLVER", None)
+        self.resolve = import_by_path(path) if path else (lambda request: getattr(request, "tenant", None))
+
+    def process_request(self, request):
+        set_tenant(self.resolve(request))
+
+    def process_response(self, request, response):
+        set_tenant(None)
+        return response
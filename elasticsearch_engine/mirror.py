@@ -0,0 +1,173 @@
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished
+from django.db import connections
+from django.db.models import signals
+
+from .bulk import BULK_CHUNK_SIZE, bulk_write, delete_action, document_routing, index_action, instance_document, \
+    routing_column
+from .cursor import delete_by_query
+from .denormalize import denormalized_fields
+from .partition import document_index, model_indices, partitioning
+from .router import primary_database
+from .tenancy import current_tenant, get_tenant, tag_document, tenant
+
+__doc__ = "Rows of SQL models copied into elasticsearch after they are saved or deleted"
+
+logger = logging.getLogger(__name__)
+
+# Seconds committed changes are collected before they are sent; changes to
+# the same row within it cost one action
+MIRROR_WINDOW = 1.0
+
+
+def mirror_database(model):
+    """The alias of the elasticsearch database ``model``'s rows are mirrored into, or None."""
+    option = getattr(getattr(model, "ESMeta", None), "mirror", None)
+    if not option:
+        return None
+    if option is not True:
+        return option
+    alias = primary_database()
+    if alias is not None:
+        return alias
+    raise ImproperlyConfigured("%s is mirrored but no elasticsearch database is configured"
+                               % model._meta.object_name)
+
+
+class Mirror(object):
+    """
+    Rows of mirrored models changed since the last batch, sent through
+    _bulk once the transaction that changed them has ended. Only the keys
+    of the rows are kept, so a row changed many times costs one action:
+    when the batch is sent each row is read from its SQL database and
+    indexed, or deleted from elasticsearch if it no longer exists, which
+    also makes the changes of rolled back transactions harmless.
+    """
+
+    def __init__(self, window=MIRROR_WINDOW, batch_size=BULK_CHUNK_SIZE):
+        self.window = window
+        self.batch_size = batch_size
+        # id(SQL connection) -> (connection, keys changed in its atomic block)
+        self._held = {}
+        # (elasticsearch alias, SQL alias, model, tenant) -> pks
+        self._committed = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def record(self, alias, using, model, pk):
+        """
+        Mirror the row of ``model`` with ``pk`` changed through database
+        ``using`` into ``alias``, in the index of the current tenant.
+        """
+        # Raised in the saving thread rather than the worker's
+        current_tenant(connections[alias])
+        connection = connections[using]
+        with self._lock:
+            held = self._held.setdefault(id(connection), (connection, OrderedDict()))[1]
+            held[(alias, using, model, get_tenant(), pk)] = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="es-mirror")
+                self._thread.daemon = True
+                self._thread.start()
+        self.release()
+
+    def release(self, sql_connections=None):
+        """
+        Queue the changes of the transactions that have ended, of
+        ``sql_connections`` only if given. The worker calls it every
+        window, which misses a transaction followed by another before it
+        looks; request_finished calls it for the request's connections.
+        Code running outside requests can call it once it commits.
+        """
+        keys = None if sql_connections is None else set(id(connection) for connection in sql_connections)
+        with self._lock:
+            for key, (connection, held) in self._held.items():
+                if connection.in_atomic_block or (keys is not None and key not in keys):
+                    continue
+                del self._held[key]
+                for alias, using, model, name, pk in held:
+                    self._committed.setdefault((alias, using, model, name), OrderedDict())[pk] = True
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            try:
+                self.release()
+                self.send()
+            except Exception:
+                logger.exception("Mirroring changed rows failed")
+
+    def _actions(self, alias, using, model, pks):
+        es = connections[alias]
+        db_name, doc_type = es.db_name, model._meta.db_table
+        queryset = model._default_manager.using(using)
+        related = [field.name for field in denormalized_fields(model)]
+        if related:
+            queryset = queryset.select_related(*related)
+        rows = {}
+        for start in xrange(0, len(pks), self.batch_size):
+            rows.update(queryset.in_bulk(pks[start:start + self.batch_size]))
+        gone = []
+        for pk in pks:
+            obj = rows.get(pk)
+            if obj is not None:
+                document = instance_document(obj, es)
+                tag_document(es, model, document)
+                yield index_action(document_index(db_name, model, document), doc_type, pk, document,
+                                   document_routing(model, document))
+            elif partitioning(model) is None and routing_column(model) is None:
+                yield delete_action(db_name, doc_type, pk)
+            else:
+                gone.append(pk)
+        if gone:
+            # The partition and routing a deleted row had are unknown
+            delete_by_query(es.db_connection, model_indices(db_name, model), [doc_type], {"ids": {"values": gone}})
+
+    def send(self):
+        """Send the queued changes."""
+        with self._lock:
+            committed, self._committed = self._committed, OrderedDict()
+        for (alias, using, model, name), pks in committed.items():
+            # The worker thread has no tenant of its own
+            with tenant(name):
+                failures = bulk_write(connections[alias].db_connection,
+                                      self._actions(alias, using, model, pks.keys()),
+                                      self.batch_size, raise_on_error=False)
+            for failure in failures:
+                logger.error("Mirroring %s of %s failed: %s", failure["action"], failure["_id"], failure["error"])
+
+    def flush(self):
+        """Send the changes of every ended transaction now."""
+        self.release()
+        self.send()
+
+
+mirror = Mirror()
+atexit.register(mirror.flush)
+
+
+def mirror_change(sender, instance, using, **kwargs):
+    alias = mirror_database(sender)
+    if alias is not None and alias != using:
+        mirror.record(alias, using, sender, instance.pk)
+
+
+def release_request_changes(sender, **kwargs):
+    # The connections of this thread, whose transactions ended with the request
+    mirror.release(connections.all())
+
+
+request_finished.connect(release_request_changes, dispatch_uid="es-mirror-request-finished")
+
+
+def register_model(model):
+    """Mirror the rows of ``model`` if its ESMeta asks for it."""
+    if getattr(getattr(model, "ESMeta", None), "mirror", None) and not model._meta.abstract:
+        signals.post_save.connect(mirror_change, sender=model, dispatch_uid="es-mirror-save-%s" % id(model))
+        signals.post_delete.connect(mirror_change, sender=model, dispatch_uid="es-mirror-delete-%s" % id(model))
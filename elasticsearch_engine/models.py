@@ -2,7 +2,26 @@ from django.db.models import signals, FieldDoesNotExist, Manager
 
 
 class ESMeta(object):
-    pass
+    # Mapping profile of the model's fields (see mapping.PROFILES)
+    mapping_profile = None
+    # Mapping profile per field name, overriding mapping_profile
+    field_profiles = {}
+    # "strict" rejects documents with fields missing from the mapping, so
+    # building the mapping raises for columns it has no type for
+    dynamic = None
+    # True or names of foreign keys whose targets are embedded in the documents
+    denormalize = False
+    # Alias of the elasticsearch database the rows of a SQL model are
+    # copied into on save and delete, True for the one written to (see
+    # router.primary_database)
+    mirror = None
+    # Date field splitting the documents over one index per partition_interval
+    partition_by = None
+    # "day", "month" or "year"
+    partition_interval = "month"
+    # Field whose value routes the documents to a shard; searches pinning
+    # it only query that shard
+    routing_field = None
 
 
 def add_elasticsearch_manager(sender, *args, **kwargs):
@@ -31,4 +50,27 @@ def add_elasticsearch_manager(sender, *args, **kwargs):
                 setattr(cls._meta, attr, es_meta[attr])
 
 
-signals.class_prepared.connect(add_elasticsearch_manager)
\ No newline at end of file
+def add_denormalization(sender, *args, **kwargs):
+    from .denormalize import register_model
+
+    register_model(sender)
+
+
+def add_mirroring(sender, *args, **kwargs):
+    from .manager import Manager as ESManager
+    from .mirror import mirror_database, register_model
+
+    if sender._meta.abstract:
+        return
+    register_model(sender)
+    alias = mirror_database(sender)
+    if alias is not None and getattr(sender, 'es', None) is None:
+        # Searches the copies of the rows
+        manager = ESManager()
+        manager._db = alias
+        setattr(sender, 'es', manager)
+
+
+signals.class_prepared.connect(add_elasticsearch_manager)
+signals.class_prepared.connect(add_denormalization)
+signals.class_prepared.connect(add_mirroring)
@@ -0,0 +1,374 @@
+import json
+import logging
+from datetime import date
+from numbers import Number
+
+from .query import MATCH_ALL, _clause_key, _unique
+
+__doc__ = "Rewrites of compiled queries applied before they are sent to elasticsearch"
+
+logger = logging.getLogger(__name__)
+
+# A query nothing matches; searches and counts for it are answered
+# without a request
+MATCH_NONE = {"match_none": {}}
+
+# Leaf clauses that only decide whether a document matches; in filter
+# context they skip scoring and can be cached
+NON_SCORING = frozenset(["term", "terms", "range", "exists", "regexp", "prefix", "wildcard", "ids", "script",
+                         "match_all", "match_none"])
+
+RANGE_BOUNDS = frozenset(["gt", "gte", "lt", "lte"])
+
+# Field types whose documents can hold several values, on which bounds of
+# separate range clauses may be met by different values
+MULTI_VALUED_TYPES = ("ListField", "SetField", "TextField")
+
+# model -> columns mapped as keywords
+_KEYWORDS = {}
+
+
+def multi_valued_fields(model):
+    """The columns of ``model`` that range folding must leave alone."""
+    if model is None:
+        return None
+    columns = set()
+    for field in model._meta.fields:
+        if type(field).__name__ in MULTI_VALUED_TYPES or getattr(field, "many", False):
+            columns.add(field.column)
+    return frozenset(columns)
+
+
+def keyword_fields(model):
+    """The columns of ``model`` mapped as keywords, whose string bounds sort as Python strings do."""
+    if model is None:
+        return frozenset()
+    if model not in _KEYWORDS:
+        from .mapping import model_to_mapping
+
+        properties = model_to_mapping(model).as_dict().get("properties", {})
+        columns = set()
+        for field in model._meta.fields:
+            data = properties.get(field.column) or properties.get(field.name, {})
+            if data.get("type") == "keyword":
+                columns.add(field.column)
+        _KEYWORDS[model] = frozenset(columns)
+    return _KEYWORDS[model]
+
+
+def _as_list(clauses):
+    if clauses is None:
+        return []
+    if isinstance(clauses, dict):
+        return [clauses]
+    return list(clauses)
+
+
+def _leaf_name(clause):
+    if len(clause) == 1:
+        return clause.keys()[0]
+    return None
+
+
+def _simple_term(clause):
+    """(field, values) of a term or terms clause without options, or None."""
+    name = _leaf_name(clause)
+    if name not in ("term", "terms") or len(clause[name]) != 1:
+        return None
+    field, value = clause[name].items()[0]
+    if name == "term":
+        if isinstance(value, dict):
+            return None
+        return field, [value]
+    if not isinstance(value, list):
+        return None
+    return field, value
+
+
+def _simple_range(clause):
+    """(field, bounds) of a range clause with only gt/gte/lt/lte, or None."""
+    if _leaf_name(clause) != "range" or len(clause["range"]) != 1:
+        return None
+    field, bounds = clause["range"].items()[0]
+    if not bounds or set(bounds) - RANGE_BOUNDS:
+        return None
+    return field, bounds
+
+
+def _comparable(a, b, keyword=False):
+    """
+    Whether bounds ``a`` and ``b`` order in Python as elasticsearch orders
+    them: numbers, dates of one kind, and strings of ``keyword`` fields.
+    Other strings may be numbers, dates in any format or analyzed text.
+    """
+    if isinstance(a, bool) or isinstance(b, bool):
+        return False
+    if isinstance(a, Number) and isinstance(b, Number):
+        return True
+    if isinstance(a, basestring) and isinstance(b, basestring):
+        return keyword
+    if isinstance(a, date) and type(a) is type(b):
+        # Naive and aware datetimes cannot be compared
+        return (getattr(a, "tzinfo", None) is None) == (getattr(b, "tzinfo", None) is None)
+    return False
+
+
+def _tighter(current, candidate, lower, keyword=False):
+    """The tighter of two (operator, value) bounds, or None if incomparable."""
+    if current is None:
+        return candidate
+    (op, value), (new_op, new_value) = current, candidate
+    if not _comparable(value, new_value, keyword):
+        return None
+    if value == new_value:
+        # An exclusive bound is the tighter one
+        return current if op in ("gt", "lt") else candidate
+    if lower:
+        return candidate if new_value > value else current
+    return candidate if new_value < value else current
+
+
+def _fold_ranges(filters, multi_valued, keywords):
+    """
+    Merge the range clauses on one single valued field into one. Returns
+    the new filters, or None when the bounds cannot all be met; bounds
+    that are strings never count as such.
+    """
+    bounds = {}
+    folded = []
+    for clause in filters:
+        simple = _simple_range(clause)
+        if simple is None or multi_valued is None or simple[0] in multi_valued:
+            folded.append(clause)
+            continue
+        field, field_bounds = simple
+        if field not in bounds:
+            bounds[field] = [None, None]
+            folded.append(field)
+        lower, upper = bounds[field]
+        for op, value in field_bounds.items():
+            is_lower = op in ("gt", "gte")
+            merged = _tighter(lower if is_lower else upper, (op, value), is_lower, field in keywords)
+            if merged is None:
+                # Bounds that cannot be compared; keep this clause as it is
+                folded.append({"range": {field: {op: value}}})
+            elif is_lower:
+                lower = merged
+            else:
+                upper = merged
+        bounds[field] = [lower, upper]
+
+    result = []
+    for clause in folded:
+        if not isinstance(clause, basestring):
+            result.append(clause)
+            continue
+        lower, upper = bounds[clause]
+        if lower and upper and _comparable(lower[1], upper[1]):
+            if lower[1] > upper[1] or (lower[1] == upper[1] and (lower[0] == "gt" or upper[0] == "lt")):
+                return None
+        result.append({"range": {clause: dict(bound for bound in (lower, upper) if bound)}})
+    return result
+
+
+def _merge_terms(should):
+    """Merge the term/terms clauses on one field into a single terms clause."""
+    values = {}
+    merged = []
+    for clause in should:
+        simple = _simple_term(clause)
+        if simple is None:
+            merged.append(clause)
+            continue
+        field, field_values = simple
+        if field not in values:
+            values[field] = []
+            merged.append(field)
+        for value in field_values:
+            if value not in values[field]:
+                values[field].append(value)
+    result = []
+    for clause in merged:
+        if not isinstance(clause, basestring):
+            result.append(clause)
+        elif len(values[clause]) == 1:
+            result.append({"term": {clause: values[clause][0]}})
+        else:
+            result.append({"terms": {clause: values[clause]}})
+    return result
+
+
+def _only(parts, *keys):
+    return bool(parts) and not set(parts) - set(keys)
+
+
+def _restricting_should(parts):
+    """Whether the should clauses of a bool decide if documents match."""
+    msm = parts.get("minimum_should_match")
+    if msm is None:
+        return not parts.get("must") and not parts.get("filter")
+    return msm in (1, "1")
+
+
+def _rewrite(clause, multi_valued, keywords):
+    if clause.keys() == ["bool"]:
+        return _rewrite_bool(clause["bool"], multi_valued, keywords)
+    simple = _simple_term(clause)
+    if simple is not None and _leaf_name(clause) == "terms":
+        field, values = simple
+        if not values:
+            return MATCH_NONE
+        if len(values) == 1:
+            return {"term": {field: values[0]}}
+    return clause
+
+
+def _rewrite_bool(parts, multi_valued, keywords):
+    filters, scoring, should, must_not = [], [], [], []
+    options = dict((key, value) for key, value in parts.items()
+                   if key not in ("must", "filter", "should", "must_not", "minimum_should_match"))
+
+    pending = []
+    for clause in _as_list(parts.get("must")):
+        clause = _rewrite(clause, multi_valued, keywords)
+        if _leaf_name(clause) in NON_SCORING or (clause.keys() == ["bool"] and "must" not in clause["bool"]):
+            pending.append(clause)
+        else:
+            scoring.append(clause)
+    pending.extend(_rewrite(clause, multi_valued, keywords) for clause in _as_list(parts.get("filter")))
+    while pending:
+        clause = pending.pop(0)
+        if clause == MATCH_NONE:
+            return MATCH_NONE
+        if clause == MATCH_ALL:
+            continue
+        inner = clause.get("bool") if clause.keys() == ["bool"] else None
+        if inner is not None and _only(inner, "filter", "must_not"):
+            pending.extend(_as_list(inner.get("filter")))
+            must_not.extend(_as_list(inner.get("must_not")))
+            continue
+        filters.append(clause)
+
+    restricting = _restricting_should(parts)
+    if restricting:
+        pending = [_rewrite(clause, multi_valued, keywords) for clause in _as_list(parts.get("should"))]
+        had_should = bool(pending)
+        while pending:
+            clause = pending.pop(0)
+            if clause == MATCH_NONE:
+                continue
+            if clause == MATCH_ALL:
+                # One alternative always matches
+                should, pending, had_should = [], [], False
+                break
+            inner = clause.get("bool") if clause.keys() == ["bool"] else None
+            if inner is not None and _only(inner, "should", "minimum_should_match") and _restricting_should(inner):
+                pending.extend(_as_list(inner["should"]))
+                continue
+            should.append(clause)
+        if had_should and not should:
+            return MATCH_NONE
+        should = _merge_terms(_unique(should))
+    else:
+        should = _as_list(parts.get("should"))
+
+    pending = [_rewrite(clause, multi_valued, keywords) for clause in _as_list(parts.get("must_not"))]
+    while pending:
+        clause = pending.pop(0)
+        if clause == MATCH_NONE:
+            continue
+        if clause == MATCH_ALL:
+            return MATCH_NONE
+        inner = clause.get("bool") if clause.keys() == ["bool"] else None
+        if inner is not None and _only(inner, "should", "minimum_should_match") and _restricting_should(inner):
+            # not (a or b) is (not a) and (not b)
+            pending.extend(_as_list(inner["should"]))
+            continue
+        if inner is not None and inner.keys() == ["must_not"] and len(_as_list(inner["must_not"])) == 1:
+            filters.append(_as_list(inner["must_not"])[0])
+            continue
+        must_not.append(clause)
+
+    filters = _fold_ranges(_unique(filters), multi_valued, keywords)
+    if filters is None:
+        return MATCH_NONE
+    must_not = _merge_terms(_unique(must_not))
+    excluded = set(_clause_key(clause) for clause in must_not)
+    if any(_clause_key(clause) in excluded for clause in filters + scoring):
+        return MATCH_NONE
+
+    if restricting and should and not filters and not scoring and not must_not and not options \
+            and len(should) == 1:
+        return should[0]
+    if restricting and should and not (filters or scoring or must_not or options):
+        return {"bool": {"should": should, "minimum_should_match": 1}}
+    if not should and not scoring and not must_not and not options:
+        if not filters:
+            return MATCH_ALL
+        if len(filters) == 1:
+            return filters[0]
+
+    result = dict(options)
+    if scoring:
+        result["must"] = scoring
+    if filters:
+        result["filter"] = filters
+    if should:
+        result["should"] = should
+        if restricting and (filters or scoring):
+            result["minimum_should_match"] = 1
+        elif "minimum_should_match" in parts:
+            result["minimum_should_match"] = parts["minimum_should_match"]
+    if must_not:
+        result["must_not"] = must_not
+    return {"bool": result}
+
+
+def pinned_values(query, column):
+    """
+    The values ``query`` requires ``column`` to hold one of, from the
+    term and terms clauses of its filter context, or None when it matches
+    any value of ``column``.
+    """
+    pinned = None
+    parts = query["bool"] if query.keys() == ["bool"] else {"filter": [query]}
+    for clause in _as_list(parts.get("filter")) + _as_list(parts.get("must")):
+        if clause.keys() == ["bool"]:
+            values = pinned_values(clause, column) if "should" not in clause["bool"] else None
+        else:
+            simple = _simple_term(clause)
+            values = simple[1] if simple is not None and simple[0] == column else None
+        if values is not None:
+            pinned = list(values) if pinned is None else [value for value in pinned if value in values]
+    return pinned
+
+
+def optimize(query, multi_valued=None, keywords=frozenset()):
+    """
+    Rewrite a compiled query into an equivalent cheaper one:
+
+    - term/terms alternatives on one field become a single terms clause
+    - range bounds on one field are folded into one range, and bounds that
+      cannot all be met make the whole query MATCH_NONE
+    - match_all filters, match_none alternatives and nested bools of the
+      same kind are removed, a clause both required and excluded is a
+      contradiction
+    - non-scoring clauses move from must into filter context
+
+    ``multi_valued`` are the fields range folding must not touch, None
+    when they are not known, which disables folding. String bounds are
+    only folded on the ``keywords`` fields.
+    """
+    optimized = _rewrite(query, multi_valued, keywords)
+    if _leaf_name(optimized) in NON_SCORING and optimized not in (MATCH_ALL, MATCH_NONE):
+        optimized = {"bool": {"filter": [optimized]}}
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(rewrite_report(query, optimized))
+    return optimized
+
+
+def rewrite_report(before, after):
+    """The query before and after optimize(), for debugging."""
+    return "query before rewrite:\n%s\nquery after rewrite:\n%s" % (
+        json.dumps(before, indent=2, sort_keys=True, default=repr),
+        json.dumps(after, indent=2, sort_keys=True, default=repr))
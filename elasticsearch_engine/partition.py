@@ -0,0 +1,194 @@
+import time
+from datetime import date, datetime, timedelta
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.utils import DatabaseError
+
+__doc__ = "Documents of a model spread over one index per day, month or year of a date field"
+
+# strftime format of the index suffix of each partition interval
+PARTITION_FORMATS = {"day": "%Y.%m.%d", "month": "%Y.%m", "year": "%Y"}
+
+# Seconds the list of partition indices is reused before it is fetched again
+PARTITION_CACHE_SECONDS = 60
+
+# Above this many indices a search uses the pattern of every partition
+MAX_PRUNED_PARTITIONS = 100
+
+# Request parameters of searches naming partitions that may not exist
+PRUNED_SEARCH_PARAMS = {"ignore_unavailable": "true", "allow_no_indices": "true"}
+
+# (database name, model) -> (time listed, set of partition indices)
+_KNOWN = {}
+
+
+def partitioning(model):
+    """(date field, interval) ``model``'s documents are partitioned by, or None."""
+    es_meta = getattr(model, "ESMeta", None)
+    name = getattr(es_meta, "partition_by", None)
+    if not name:
+        return None
+    interval = getattr(es_meta, "partition_interval", "month")
+    if interval not in PARTITION_FORMATS:
+        raise ImproperlyConfigured("partition_interval of %s must be one of %s"
+                                   % (model._meta.object_name, ", ".join(sorted(PARTITION_FORMATS))))
+    return model._meta.get_field(name), interval
+
+
+def partition_alias(db_name, model):
+    """The alias of every partition of ``model``, and the prefix of their names."""
+    return "%s-%s" % (db_name, model._meta.db_table)
+
+
+def partition_pattern(db_name, model):
+    return partition_alias(db_name, model) + "-*"
+
+
+def _as_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    if isinstance(value, basestring):
+        try:
+            return datetime.strptime(value[:10], "%Y-%m-%d")
+        except ValueError:
+            return None
+    return None
+
+
+def _partition_name(db_name, model, interval, moment):
+    return "%s-%s" % (partition_alias(db_name, model), moment.strftime(PARTITION_FORMATS[interval]))
+
+
+def document_index(db_name, model, document):
+    """The index ``document``, a dict of columns, is written to."""
+    partitions = partitioning(model)
+    if partitions is None:
+        return db_name
+    field, interval = partitions
+    moment = _as_datetime(document.get(field.column))
+    if moment is None:
+        raise DatabaseError("Documents of %s are partitioned by %s, which must be a date"
+                            % (model._meta.object_name, field.name))
+    return _partition_name(db_name, model, interval, moment)
+
+
+def model_indices(db_name, model):
+    """The indices, or index pattern, holding every document of ``model``."""
+    if partitioning(model) is None:
+        return [db_name]
+    return [partition_pattern(db_name, model)]
+
+
+def list_partitions(es, db_name, model):
+    """
+    The existing partition indices of ``model``, cached
+    PARTITION_CACHE_SECONDS: partitions created or deleted meanwhile are
+    missed.
+    """
+    key = (db_name, model)
+    known = _KNOWN.get(key)
+    if known is None or time.time() - known[0] > PARTITION_CACHE_SECONDS:
+        path = "/_cat/indices/%s" % partition_pattern(db_name, model)
+        rows = es._send_request('GET', path, params={"h": "index", "format": "json"})
+        known = _KNOWN[key] = (time.time(), set(row["index"] for row in rows))
+    return known[1]
+
+
+def _bounds(query, column):
+    """The lowest and highest datetime ``query`` requires ``column`` to lie in, None where unbounded."""
+    lows, highs = [], []
+
+    def visit(clause):
+        if clause.keys() == ["bool"]:
+            parts = clause["bool"]
+            for key in ("filter", "must"):
+                children = parts.get(key, [])
+                for child in [children] if isinstance(children, dict) else children:
+                    visit(child)
+            return
+        name = clause.keys()[0] if len(clause) == 1 else None
+        if name == "range" and column in clause["range"]:
+            for op, value in clause["range"][column].items():
+                moment = _as_datetime(value)
+                if moment is not None and op in ("gt", "gte"):
+                    lows.append(moment)
+                elif moment is not None and op in ("lt", "lte"):
+                    highs.append(moment)
+        elif name == "term" and column in clause["term"]:
+            moment = _as_datetime(clause["term"][column])
+            if moment is not None:
+                lows.append(moment)
+                highs.append(moment)
+        elif name == "terms" and column in clause["terms"]:
+            moments = [_as_datetime(value) for value in clause["terms"][column]]
+            if moments and None not in moments:
+                lows.append(min(moments))
+                highs.append(max(moments))
+
+    visit(query)
+    return max(lows) if lows else None, min(highs) if highs else None
+
+
+def _next_period(moment, interval):
+    if interval == "day":
+        return moment + timedelta(days=1)
+    if interval == "month":
+        return datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1)
+    return datetime(moment.year + 1, 1, 1)
+
+
+def _period_names(db_name, model, interval, low, high):
+    """The partitions from the one of ``low`` to the one of ``high``, None if more than MAX_PRUNED_PARTITIONS."""
+    last = _partition_name(db_name, model, interval, high)
+    moment = datetime(low.year, low.month if interval != "year" else 1, low.day if interval == "day" else 1)
+    names = []
+    while len(names) <= MAX_PRUNED_PARTITIONS:
+        name = _partition_name(db_name, model, interval, moment)
+        if name > last:
+            return names
+        names.append(name)
+        moment = _next_period(moment, interval)
+    return None
+
+
+def search_indices(es, db_name, model, query):
+    """
+    The indices a search for ``query`` on ``model``'s documents needs: for
+    a partitioned model only the partitions overlapping the query's range
+    on the partition field, maybe none. Some of them may not exist, so
+    searches naming them send PRUNED_SEARCH_PARAMS.
+    """
+    partitions = partitioning(model)
+    if partitions is None:
+        return [db_name]
+    field, interval = partitions
+    low, high = _bounds(query, field.column)
+    if low is None and high is None:
+        return [partition_pattern(db_name, model)]
+    if low is not None and high is not None:
+        # Every period of the range, whichever process created its partition
+        names = _period_names(db_name, model, interval, low, high)
+        if names is not None:
+            return names
+    # Partition names sort like the periods they hold
+    first = low and _partition_name(db_name, model, interval, low)
+    last = high and _partition_name(db_name, model, interval, high)
+    indices = set(list_partitions(es, db_name, model))
+    # Created since the partitions were listed most likely
+    indices.add(_partition_name(db_name, model, interval, datetime.utcnow()))
+    indices = sorted(index for index in indices
+                     if (first is None or index >= first) and (last is None or index <= last))
+    if len(indices) > MAX_PRUNED_PARTITIONS:
+        return [partition_pattern(db_name, model)]
+    return indices
+
+
+def index_template(db_name, model, mapping):
+    """The index template giving new partitions of ``model`` their mapping and alias."""
+    return {
+        "index_patterns": [partition_pattern(db_name, model)],
+        "mappings": {model._meta.db_table: mapping},
+        "aliases": {partition_alias(db_name, model): {}},
+    }
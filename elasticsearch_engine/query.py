@@ -1,36 +1,91 @@
 import copy
+import json
 
-from .manager import QuerySet, RE_TYPE
+MATCH_ALL = {"match_all": {}}
+
+
+def _clause_key(clause):
+    return json.dumps(clause, sort_keys=True, default=repr)
+
+
+def _unique(clauses):
+    seen = set()
+    unique = []
+    for clause in clauses:
+        key = _clause_key(clause)
+        if key not in seen:
+            seen.add(key)
+            unique.append(clause)
+    return unique
+
+
+def _bool_parts(clause, *keys):
+    """The members of a bool clause made only of ``keys``, or None."""
+    if clause.keys() != ["bool"]:
+        return None
+    parts = clause["bool"]
+    if set(parts) - set(keys):
+        return None
+    return parts
+
+
+def and_clauses(filters, must_not=()):
+    """A clause matching ``filters`` and none of ``must_not``."""
+    filters = _unique(clause for clause in filters if clause != MATCH_ALL)
+    must_not = _unique(must_not)
+    if not must_not:
+        if not filters:
+            return MATCH_ALL
+        if len(filters) == 1:
+            return filters[0]
+    query = {}
+    if filters:
+        query["filter"] = filters
+    if must_not:
+        query["must_not"] = must_not
+    return {"bool": query}
+
+
+def or_clauses(should):
+    """A clause matching any of ``should``."""
+    should = _unique(should)
+    if MATCH_ALL in should:
+        return MATCH_ALL
+    if len(should) == 1:
+        return should[0]
+    return {"bool": {"should": should, "minimum_should_match": 1}}
+
+
+def not_clause(clause):
+    """A clause matching what ``clause`` does not."""
+    parts = _bool_parts(clause, "must_not")
+    if parts is not None and len(parts["must_not"]) == 1:
+        return parts["must_not"][0]
+    return {"bool": {"must_not": [clause]}}
 
 
 class Q(object):
-    OR = '||'
-    AND = '&&'
-    OPERATORS = {
-        'eq': 'this.%(field)s == %(value)s',
-        'ne': 'this.%(field)s != %(value)s',
-        'gt': 'this.%(field)s > %(value)s',
-        'gte': 'this.%(field)s >= %(value)s',
-        'lt': 'this.%(field)s < %(value)s',
-        'lte': 'this.%(field)s <= %(value)s',
-        'in': '%(value)s.indexOf(this.%(field)s) != -1',
-        'nin': '%(value)s.indexOf(this.%(field)s) == -1',
-        'mod': '%(field)s %% %(value)s',
-        'all': ('%(value)s.every(function(a){'
-                'return this.%(field)s.indexOf(a) != -1 })'),
-        'size': 'this.%(field)s.length == %(value)s',
-        'exists': 'this.%(field)s != null',
-        'regex_eq': '%(value)s.test(this.%(field)s)',
-        'regex_ne': '!%(value)s.test(this.%(field)s)',
-    }
+    """
+    A tree of lookups combined with ``&``, ``|`` and ``~``, compiled into
+    nested bool ``filter``/``should``/``must_not`` clauses.
+    """
+    AND = 'AND'
+    OR = 'OR'
 
     def __init__(self, **query):
-        self.query = [query]
+        self.connector = self.AND
+        self.negated = False
+        self.children = [query] if query else []
 
-    def _combine(self, other, op):
+    def _combine(self, other, connector):
         obj = Q()
-        obj.query = ['('] + copy.deepcopy(self.query) + [op]
-        obj.query += copy.deepcopy(other.query) + [')']
+        obj.connector = connector
+        for node in (self, other):
+            # Chains of one operator are kept as a single level
+            if not node.negated and (node.connector == connector or len(node.children) == 1):
+                obj.children.extend(copy.deepcopy(node.children))
+            else:
+                obj.children.append(copy.deepcopy(node))
         return obj
 
     def __or__(self, other):
@@ -39,62 +94,40 @@ class Q(object):
     def __and__(self, other):
         return self._combine(other, self.AND)
 
-    def as_js(self, document):
-        js = []
-        js_scope = {}
-        for i, item in enumerate(self.query):
-            if isinstance(item, dict):
-                item_query = QuerySet._transform_query(document, **item)
-                # item_query will values will either be a value or a dict
-                js.append(self._item_query_as_js(item_query, js_scope, i))
-            else:
-                js.append(item)
-        return None
+    def __invert__(self):
+        obj = copy.deepcopy(self)
+        obj.negated = not self.negated
+        return obj
 
-    def _item_query_as_js(self, item_query, js_scope, item_num):
-        # item_query will be in one of the following forms
-        # {'age': 25, 'name': 'Test'}
-        # {'age': {'$lt': 25}, 'name': {'$in': ['Test', 'Example']}
-        # {'age': {'$lt': 25, '$gt': 18}}
-        js = []
-        for i, (key, value) in enumerate(item_query.items()):
-            op = 'eq'
-            # Construct a variable name for the value in the JS
-            value_name = 'i%sf%s' % (item_num, i)
-            if isinstance(value, dict):
-                # Multiple operators for this field
-                for j, (op, value) in enumerate(value.items()):
-                    # Create a custom variable name for this operator
-                    op_value_name = '%so%s' % (value_name, j)
-                    # Construct the JS that uses this op
-                    value, operation_js = self._build_op_js(op, key, value,
-                                                            op_value_name)
-                    # Update the js scope with the value for this op
-                    js_scope[op_value_name] = value
-                    js.append(operation_js)
-            else:
-                # Construct the JS for this field
-                value, field_js = self._build_op_js(op, key, value, value_name)
-                js_scope[value_name] = value
-                js.append(field_js)
-        return ' && '.join(js)
-
-    def _build_op_js(self, op, key, value, value_name):
-        """
-            Substitute the values in to the correct chunk of Javascript.
-        """
-        if isinstance(value, RE_TYPE):
-            # Regexes are handled specially
-            if op.strip('$') == 'ne':
-                op_js = Q.OPERATORS['regex_ne']
-            else:
-                op_js = Q.OPERATORS['regex_eq']
+    def to_query(self, document):
+        """The elasticsearch query for this tree on ``document``'s fields."""
+        # optimizer.py, which the cursor imports, uses the helpers above
+        from .cursor import spec_to_clauses
+        from .manager import QuerySet
+
+        if self.connector == self.AND:
+            filters, must_not = [], []
+            for child in self.children:
+                if isinstance(child, dict):
+                    must, excluded = spec_to_clauses(QuerySet._transform_query(document, **child))
+                    filters.extend(must)
+                    must_not.extend(excluded)
+                    continue
+                clause = child.to_query(document)
+                parts = _bool_parts(clause, "filter", "must_not")
+                if parts is not None:
+                    filters.extend(parts.get("filter", []))
+                    must_not.extend(parts.get("must_not", []))
+                else:
+                    filters.append(clause)
+            clause = and_clauses(filters, must_not)
         else:
-            op_js = Q.OPERATORS[op.strip('$')]
-
-        # Perform the substitution
-        operation_js = op_js % {
-            'field': key,
-            'value': value_name
-        }
-        return value, operation_js
+            should = []
+            for child in self.children:
+                if isinstance(child, dict):
+                    child = Q(**child)
+                clause = child.to_query(document)
+                parts = _bool_parts(clause, "should", "minimum_should_match")
+                should.extend(parts["should"] if parts is not None else [clause])
+            clause = or_clauses(should)
+        return not_clause(clause) if self.negated else clause
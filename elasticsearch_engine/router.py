@@ -1,42 +1,169 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two health checks of each read database
+HEALTH_CHECK_INTERVAL = 10
+
+# Weight of the newest measure in the moving average of a database's latency
+LATENCY_SMOOTHING = 0.3
+
+
+def elasticsearch_databases():
+    """The aliases of the elasticsearch databases in DATABASES."""
+    from django.conf import settings
+
+    return [name for name, database_options in settings.DATABASES.items()
+            if 'elasticsearch' in database_options["ENGINE"]]
+
+
+def primary_database():
+    """
+        The alias of the elasticsearch database written to,
+        ELASTICSEARCH_PRIMARY_DATABASE, required when there are several;
+        None without elasticsearch databases
+    """
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+
+    databases = elasticsearch_databases()
+    primary = getattr(settings, "ELASTICSEARCH_PRIMARY_DATABASE", None)
+    if primary is not None or not databases:
+        return primary
+    if len(databases) > 1:
+        # DATABASES has no order, writes could go to a read replica
+        raise ImproperlyConfigured("ELASTICSEARCH_PRIMARY_DATABASE must name the database written to "
+                                   "among %s" % ", ".join(sorted(databases)))
+    return databases[0]
+
+
+class LatencyTracker(object):
+    """
+        Moving average latency and health of elasticsearch databases,
+        measured with a cluster health request to each of them from a
+        background thread
+    """
+
+    def __init__(self, aliases, interval=HEALTH_CHECK_INTERVAL):
+        self.aliases = list(aliases)
+        self.interval = interval
+        self.latency = {}
+        self.healthy = dict((alias, True) for alias in self.aliases)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="es-router-health")
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            for alias in self.aliases:
+                self.check(alias)
+            time.sleep(self.interval)
+
+    def check(self, alias):
+        from django.db import connections
+
+        started = time.time()
+        try:
+            health = connections[alias].db_connection.cluster_health()
+        except Exception, e:
+            logger.warning("Elasticsearch database %s is unreachable: %s", alias, e)
+            self.healthy[alias] = False
+            return
+        self.observe(alias, time.time() - started)
+        self.healthy[alias] = health.get("status") != "red"
+
+    def observe(self, alias, seconds):
+        previous = self.latency.get(alias)
+        if previous is None:
+            self.latency[alias] = seconds
+        else:
+            self.latency[alias] = previous + LATENCY_SMOOTHING * (seconds - previous)
+
+    def choose(self, aliases):
+        """
+            A healthy alias of aliases, picked at random with odds inverse
+            to its latency; None if none is healthy
+        """
+        candidates = [alias for alias in aliases if self.healthy.get(alias, True)]
+        if len(candidates) < 2:
+            return candidates[0] if candidates else None
+        # Not measured yet: as fast as the fastest
+        fastest = min(self.latency.values()) if self.latency else 1.0
+        weights = [1.0 / max(self.latency.get(alias, fastest), 0.001) for alias in candidates]
+        point = random.random() * sum(weights)
+        for alias, weight in zip(candidates, weights):
+            point -= weight
+            if point < 0:
+                return alias
+        return candidates[-1]
+
+
 class ESRouter(object):
     """
         A router to control all database operations on models in
         the my app application
+
+        Writes go to the primary elasticsearch database,
+        ELASTICSEARCH_PRIMARY_DATABASE, required when there are several.
+        Reads are spread over ELASTICSEARCH_READ_DATABASES, every
+        elasticsearch database by default, favouring the faster ones and
+        skipping those failing their health checks.
     """
 
     def __init__(self):
         from django.conf import settings
 
-        self.managed_apps = [app.split('.')[-1] for app in getattr(settings, "ELASTICSEARCH_MANAGED_APPS", [])]
-        self.managed_models = getattr(settings, "ELASTICSEARCH_MANAGED_MODELS", [])
-        self.elasticsearch_database = None
-        self.elasticsearch_databases = []
-        for name, database_options in settings.DATABASES.items():
-            if database_options["ENGINE"] == 'django_elasticsearch':
-                self.elasticsearch_database = name
-                self.elasticsearch_databases.append(name)
-        if self.elasticsearch_database is None:
+        self.managed_apps = frozenset(app.split('.')[-1] for app in getattr(settings, "ELASTICSEARCH_MANAGED_APPS", []))
+        self.managed_models = frozenset(getattr(settings, "ELASTICSEARCH_MANAGED_MODELS", []))
+        self.elasticsearch_databases = elasticsearch_databases()
+        if not self.elasticsearch_databases:
             raise RuntimeError("A elasticsearch database must be set")
+        self.elasticsearch_database = primary_database()
+        self.read_databases = list(getattr(settings, "ELASTICSEARCH_READ_DATABASES", self.elasticsearch_databases))
+        self.latency = LatencyTracker(self.read_databases,
+                                      getattr(settings, "ELASTICSEARCH_HEALTH_CHECK_INTERVAL", HEALTH_CHECK_INTERVAL))
+        # model -> whether it is stored in elasticsearch
+        self._routes = {}
+
+    def is_managed(self, model):
+        try:
+            return self._routes[model]
+        except KeyError:
+            key = "%s.%s" % (model._meta.app_label, model._meta.module_name)
+            managed = self._routes[model] = model._meta.app_label in self.managed_apps or key in self.managed_models
+            return managed
 
     def db_for_read(self, model, **hints):
         """
-            Point all operations on elasticsearch models to a elasticsearch database
+            Point reads of elasticsearch models to the healthiest and
+            fastest read database
         """
-        if model._meta.app_label in self.managed_apps:
-            return self.elasticsearch_database
-        key = "%s.%s" % (model._meta.app_label, model._meta.module_name)
-        if key in self.managed_models:
+        if not self.is_managed(model):
+            return None
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db in self.elasticsearch_databases:
+            # Related objects are read where the instance came from
+            return instance._state.db
+        if len(self.read_databases) < 2:
             return self.elasticsearch_database
-        return None
+        self.latency.start()
+        return self.latency.choose(self.read_databases) or self.elasticsearch_database
 
     def db_for_write(self, model, **hints):
         """
-            Point all operations on elasticsearch models to a elasticsearch database
+            Point all writes of elasticsearch models to the primary elasticsearch database
         """
-        if model._meta.app_label in self.managed_apps:
-            return self.elasticsearch_database
-        key = "%s.%s" % (model._meta.app_label, model._meta.module_name)
-        if key in self.managed_models:
+        if self.is_managed(model):
             return self.elasticsearch_database
         return None
 
@@ -44,13 +171,10 @@ class ESRouter(object):
         """
             Allow any relation if a model in my app is involved
         """
-        # key1 = "%s.%s"%(obj1._meta.app_label, obj1._meta.module_name)
-        key2 = "%s.%s" % (obj2._meta.app_label, obj2._meta.module_name)
-
         # obj2 is the model instance so, mongo_serializer should take care
         # of the related object. We keep track of the obj1 db so, don't worry
         # about the multi-database management
-        if obj2._meta.app_label in self.managed_apps or key2 in self.managed_models:
+        if self.is_managed(type(obj2)):
             return True
 
         return None
@@ -59,14 +183,10 @@ class ESRouter(object):
         """
             Make sure that a elasticsearch model appears on a elasticsearch database
         """
-        key = "%s.%s" % (model._meta.app_label, model._meta.module_name)
         if db in self.elasticsearch_databases:
-            return model._meta.app_label in self.managed_apps or key in self.managed_models
-        elif model._meta.app_label in self.managed_apps or key in self.managed_models:
-            if db in self.elasticsearch_databases:
-                return True
-            else:
-                return False
+            return self.is_managed(model)
+        elif self.is_managed(model):
+            return False
         return None
 
     def valid_for_db_engine(self, driver, model):
@@ -75,9 +195,6 @@ class ESRouter(object):
         """
         if driver != "elasticsearch":
             return None
-        if model._meta.app_label in self.managed_apps:
+        if self.is_managed(model):
             return True
-        key = "%s.%s" % (model._meta.app_label, model._meta.module_name)
-        if key in self.managed_models:
-            return True
-        return None
\ No newline at end of file
+        return None
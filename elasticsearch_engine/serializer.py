@@ -1,10 +1,20 @@
 from django.utils.importlib import import_module
 from datetime import datetime, date, time
+from decimal import Decimal
 # TODO Add content type cache
 from utils import ModelLazyObject
 from json import JSONDecoder, JSONEncoder
+import re
 import uuid
 
+# Bytes read from a streamed response at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_STRING_END = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_SCALAR_END = re.compile(r'[,}\]\s]')
+_WHITESPACE = re.compile(r'\s*')
+
 
 class Decoder(JSONDecoder):
     """Extends the base simplejson JSONDecoder for Dejavu."""
@@ -16,23 +26,10 @@ class Decoder(JSONDecoder):
         self.arena = arena
 
     def json_to_python(self, son):
-
-        if isinstance(son, dict):
-            if "_type" in son and son["_type"] in [u"django", u'emb']:
-                son = self.decode_django(son)
-            else:
-                for (key, value) in son.items():
-                    if isinstance(value, dict):
-                        if "_type" in value and value["_type"] in [u"django", u'emb']:
-                            son[key] = self.decode_django(value)
-                        else:
-                            son[key] = self.json_to_python(value)
-                    elif hasattr(value, "__iter__"):  # Make sure we recurse into sub-docs
-                        son[key] = [self.json_to_python(item) for item in value]
-                    else:  # Again, make sure to recurse into sub-docs
-                        son[key] = self.json_to_python(value)
-        elif hasattr(son, "__iter__"):  # Make sure we recurse into sub-docs
-            son = [self.json_to_python(item) for item in son]
+        # The json module calls this hook on every object once its members
+        # are decoded, so only the object itself needs to be looked at.
+        if "_type" in son and son["_type"] in (u"django", u"emb"):
+            son = self.decode_django(son)
         return son
 
     def decode_django(self, data):
@@ -54,14 +51,228 @@ class Decoder(JSONDecoder):
             data.pop('_id', None)
             values = {}
             for k, v in data.items():
-                values[str(k)] = self.json_to_python(v)
+                values[str(k)] = v
             return model(**values)
 
+    def iter_hits(self, fp, meta=None, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Incrementally walk the search response read from ``fp`` and yield
+        every hit, decoded through this decoder, as soon as its closing
+        brace has been read. Scalar top level members (such as
+        ``_scroll_id``) and the members of ``hits`` other than the hits
+        themselves are stored in ``meta``.
+        """
+        scanner = _ResponseScanner(fp, chunk_size)
+        if meta is None:
+            meta = {}
+        scanner.expect('{')
+        while scanner.next_member():
+            key = self.decode(scanner.string())
+            scanner.expect(':')
+            if key != "hits":
+                raw = scanner.value()
+                if raw[0] not in '{[':
+                    meta[key] = self.decode(raw)
+                continue
+
+            scanner.expect('{')
+            while scanner.next_member():
+                key = self.decode(scanner.string())
+                scanner.expect(':')
+                if key != "hits":
+                    meta[key] = self.decode(scanner.value())
+                    continue
+                scanner.expect('[')
+                while scanner.next_member(']'):
+                    yield self.decode(scanner.value())
+
+
+class _ResponseScanner(object):
+    """
+    Walks a JSON document read from a file object without holding more
+    than the value being read in memory.
+    """
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self):
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            raise ValueError("Unexpected end of streamed response")
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def _skip_whitespace(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self._fill()
+
+    def expect(self, char):
+        if self._skip_whitespace() != char:
+            raise ValueError("Expected %r in streamed response, got %r" % (char, self.buf[self.pos]))
+        self.pos += 1
+
+    def next_member(self, end='}'):
+        """
+        Step over the separator before the next member of the current
+        object or array. Returns False once ``end`` is consumed.
+        """
+        char = self._skip_whitespace()
+        if char == ',':
+            self.pos += 1
+            char = self._skip_whitespace()
+        if char == end:
+            self.pos += 1
+            return False
+        return True
+
+    def string(self):
+        if self._skip_whitespace() != '"':
+            raise ValueError("Expected a string in streamed response")
+        return self.value()
+
+    def value(self):
+        """Return the raw text of the next value."""
+        char = self._skip_whitespace()
+        if char == '"':
+            end = self._string_end(self.pos + 1)
+        elif char in '{[':
+            end = self._container_end(self.pos)
+        else:
+            end = self._scalar_end(self.pos)
+        raw = self.buf[self.pos:end]
+        self.pos = end
+        return raw
+
+    # The helpers below return buffer indexes. Filling the buffer only
+    # drops what precedes self.pos, so indexes are shifted back by it.
+
+    def _scalar_end(self, index):
+        while True:
+            match = _SCALAR_END.search(self.buf, index)
+            if match:
+                return match.start()
+            index -= self.pos
+            self._fill()
+            index += self.pos
+
+    def _string_end(self, index):
+        while True:
+            match = _STRING_END.match(self.buf, index)
+            if match:
+                return match.end()
+            index -= self.pos
+            self._fill()
+            index += self.pos
+
+    def _container_end(self, index):
+        depth = 0
+        while True:
+            match = _STRUCTURE.search(self.buf, index)
+            if match is None:
+                index = len(self.buf) - self.pos
+                self._fill()
+                index += self.pos
+                continue
+            char = match.group()
+            if char == '"':
+                index = self._string_end(match.end())
+            elif char in '{[':
+                depth += 1
+                index = match.end()
+            else:
+                depth -= 1
+                index = match.end()
+                if not depth:
+                    return index
+
+
+def _encode_as_is(encoder, value):
+    return value
+
+
+def _encode_datetime(encoder, value):
+    return value.isoformat()
+
+
+def _encode_date(encoder, value):
+    return value.isoformat() + "T00:00:00"
+
+
+def _encode_iterable(encoder, value):
+    return list(value)
+
+
+def _encode_model(encoder, value):
+    return encoder.encode_django(value)
+
+
+def _encode_unknown(encoder, value):
+    return JSONEncoder.default(encoder, value)
+
 
 class Encoder(JSONEncoder):
+    # Encoding function per value type, called as func(encoder, value)
+    _registered = {
+        str: _encode_as_is,
+        unicode: _encode_as_is,
+        int: _encode_as_is,
+        long: _encode_as_is,
+        float: _encode_as_is,
+        bool: _encode_as_is,
+        type(None): _encode_as_is,
+        dict: _encode_as_is,
+        list: _encode_as_is,
+        tuple: _encode_as_is,
+        datetime: _encode_datetime,
+        date: _encode_date,
+        time: _encode_datetime,
+        Decimal: lambda encoder, value: float(value),
+        uuid.UUID: lambda encoder, value: str(value),
+        set: _encode_iterable,
+        frozenset: _encode_iterable,
+    }
+    # Exact type dispatch table: the registered types plus the types
+    # resolved through their base classes so far
+    _encoders = dict(_registered)
+
     def __init__(self, *args, **kwargs):
         JSONEncoder.__init__(self, *args, **kwargs)
 
+    @classmethod
+    def register(cls, value_type, func):
+        """
+        Encode values of ``value_type`` and its subclasses with
+        ``func(encoder, value)``, which returns something JSON serializable.
+        """
+        cls._registered = dict(cls._registered)
+        cls._registered[value_type] = func
+        cls._encoders = dict(cls._registered)
+
+    def _resolve(self, value_type):
+        from django.db.models import Model
+
+        registered = self._registered
+        for base in value_type.__mro__[1:]:
+            if base in registered:
+                func = registered[base]
+                break
+        else:
+            if issubclass(value_type, Model):
+                func = _encode_model
+            elif hasattr(value_type, "__iter__"):  # Make sure we recurse into sub-docs
+                func = _encode_iterable
+            else:
+                func = _encode_unknown
+        self._encoders[value_type] = func
+        return func
+
     def encode_django(self, model):
         """
             Encode recursive embedded models and django models
@@ -96,22 +307,15 @@ class Encoder(JSONEncoder):
     def default(self, value):
         """Convert rogue and mysterious data types.
         Conversion notes:
-        
-        - ``datetime.date`` and ``datetime.datetime`` objects are
-        converted into datetime strings.
-        """
-        from django.db.models import Model
-        from elasticsearch_engine.fields import EmbeddedModel
 
-        if isinstance(value, datetime):
-            return value.strftime("%Y-%m-%dT%H:%M:%S")
-        elif isinstance(value, date):
-            dt = datetime(value.year, value.month, value.day, 0, 0, 0)
-            return dt.strftime("%Y-%m-%dT%H:%M:%S")
-        elif isinstance(value, (str, unicode)):
-            pass
-        elif hasattr(value, "__iter__"):  # Make sure we recurse into sub-docs
-            value = [self.transform_incoming(item, collection) for item in value]
-        elif isinstance(value, (Model, EmbeddedModel)):
-            value = self.encode_django(value)
-        return value
+        - ``datetime.datetime`` and ``datetime.time`` objects are converted
+        into ISO 8601 strings, ``datetime.date`` objects into the datetime
+        string of their midnight.
+        - ``Decimal`` becomes a float and ``UUID`` its string.
+        - Models are encoded by ``encode_django``, other iterables as lists.
+        """
+        try:
+            func = self._encoders[type(value)]
+        except KeyError:
+            func = self._resolve(type(value))
+        return func(self, value)
@@ -0,0 +1,150 @@
+import threading
+from contextlib import contextmanager
+
+from django.db.utils import DatabaseError
+from pyes.exceptions import ElasticSearchException
+
+__doc__ = "The tenant of the current thread and the index each tenant's documents live in"
+
+_local = threading.local()
+
+# (alias, base index, tenant) -> index or alias name, once it exists
+_INDICES = {}
+
+# (alias, index, model) whose mapping was checked for a tenant
+_MAPPED = set()
+
+_LOCK = threading.Lock()
+
+# The tenant inside all_tenants(): the database's own index, every tenant's
+# documents unfiltered
+ALL_TENANTS = object()
+
+
+class TenantRequired(DatabaseError):
+    """A multi-tenant database was used with no tenant set."""
+
+
+def get_tenant():
+    """
+    The tenant elasticsearch queries and writes of this thread are for,
+    ALL_TENANTS inside all_tenants(), or None.
+    """
+    return getattr(_local, "tenant", None)
+
+
+def set_tenant(tenant):
+    _local.tenant = tenant
+
+
+@contextmanager
+def tenant(name):
+    """Query and write the documents of tenant ``name`` inside the block."""
+    previous = get_tenant()
+    set_tenant(name)
+    try:
+        yield
+    finally:
+        set_tenant(previous)
+
+
+def all_tenants():
+    """
+    Query and write the database's own index inside the block: with the
+    TENANCY option it holds the documents of every tenant sharing it, so
+    it is only used without a tenant when asked for this way.
+    """
+    return tenant(ALL_TENANTS)
+
+
+def current_tenant(connection):
+    """
+    The tenant ``connection``'s queries and writes are for, None when its
+    database is not multi-tenant or inside all_tenants(). Raises
+    TenantRequired when it is multi-tenant and no tenant is set.
+    """
+    current = get_tenant()
+    if current is ALL_TENANTS or not tenancy_options(connection):
+        return None
+    if current is None:
+        raise TenantRequired("The %s database is multi-tenant: set a tenant, or use all_tenants() for "
+                             "the documents of every tenant" % connection.alias)
+    return current
+
+
+def tenancy_options(connection):
+    """
+    The TENANCY option of ``connection``'s database, None when it is not
+    multi-tenant::
+
+        'OPTIONS': {'TENANCY': {'field': 'tenant_id', 'dedicated': ['acme']}}
+
+    Tenants listed in ``dedicated`` get an index of their own, the others
+    share the database's index through an alias filtering on ``field``,
+    which the shared index should map as a keyword.
+    """
+    return connection.settings_dict.get('OPTIONS', {}).get('TENANCY')
+
+
+def tenant_index_name(base, tenant):
+    return ("%s-tenant-%s" % (base, tenant)).lower()
+
+
+def shared_tenant_field(connection, tenant):
+    """The field holding ``tenant`` in the shared index, None for dedicated tenants."""
+    options = tenancy_options(connection)
+    if not options or tenant is None or tenant in options.get("dedicated", ()):
+        return None
+    return options["field"]
+
+
+def tenant_index(connection, es, base, tenant):
+    """
+    The index, or filtered alias of ``base``, holding ``tenant``'s
+    documents, created the first time the process uses it.
+    """
+    key = (connection.alias, base, tenant)
+    try:
+        return _INDICES[key]
+    except KeyError:
+        pass
+    name = tenant_index_name(base, tenant)
+    with _LOCK:
+        if key not in _INDICES:
+            field = shared_tenant_field(connection, tenant)
+            if field is None:
+                try:
+                    es.create_index(name)
+                except ElasticSearchException:
+                    # Already created
+                    pass
+            else:
+                # Searches through the alias only see the tenant's documents,
+                # on the shard its routing picks
+                es._send_request('PUT', '/%s/_alias/%s' % (base, name),
+                                 {"filter": {"term": {field: tenant}}, "routing": unicode(tenant)})
+            _INDICES[key] = name
+    return name
+
+
+def ensure_mapping(connection, model):
+    """Put ``model``'s mapping in the current tenant's index, once per process."""
+    key = (connection.alias, connection.db_name, model)
+    if key not in _MAPPED:
+        connection.creation.sql_create_model(model, None)
+        _MAPPED.add(key)
+
+
+def tag_document(connection, model, document):
+    """
+    Ready the current tenant's index for ``model``'s documents and mark
+    ``document``, a dict of columns, with the tenant when it is shared.
+    """
+    current = current_tenant(connection)
+    if current is None:
+        return
+    ensure_mapping(connection, model)
+    field = shared_tenant_field(connection, current)
+    if field is not None:
+        # The tenant's filtered alias only sees documents holding its name
+        document[field] = current
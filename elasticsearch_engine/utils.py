@@ -1,5 +1,10 @@
+from django.db.models import ForeignKey, signals
+from django.db.models.base import ModelState
 from django.utils.functional import SimpleLazyObject
 
+# Hydration plans keyed by model class
+_HYDRATION_PLANS = {}
+
 
 def dict_keys_to_str(dictionary, recursive=False):
     res = dict([(str(k), (not isinstance(v, dict) and v) or (recursive and dict_keys_to_str(v)) or v) for k, v in
@@ -9,6 +14,106 @@ def dict_keys_to_str(dictionary, recursive=False):
     return res
 
 
+def _hydration_plan(model):
+    try:
+        return _HYDRATION_PLANS[model]
+    except KeyError:
+        from .fields import EmbeddedModelField
+
+        meta = model._meta
+        plan = _HYDRATION_PLANS[model] = (meta.pk.attname,
+                                          [(field.attname, field.get_default,
+                                            isinstance(field, EmbeddedModelField) and field.to_python or None)
+                                           for field in meta.fields])
+        return plan
+
+
+def _foreign_key_names(model):
+    return [field.name for field in model._meta.fields if isinstance(field, ForeignKey)]
+
+
+def get_hydrator(model, using=None, related=()):
+    """
+    Return a function building ``model`` instances straight from decoded
+    ``_source`` documents, like ``Model.from_db`` in later Django versions:
+    the attribute dict is filled in field order and the keyword handling of
+    ``Model.__init__`` is skipped. Models with pre_init/post_init receivers
+    keep going through the constructor so their signals still fire.
+
+    The foreign keys named in ``related`` get their cache filled from the
+    related documents embedded under their name, see denormalize.py.
+    """
+    pk_attname, fields = _hydration_plan(model)
+    hydrate = _get_hydrator(model, using, pk_attname, fields)
+    if related:
+        hydrate = _with_related(model, hydrate, related, using)
+    return hydrate
+
+
+def _with_related(model, hydrate, related, using):
+    foreign_keys = [(field.name, field.get_cache_name(), field.rel.to)
+                    for field in model._meta.fields if field.name in related]
+    hydrators = {}
+
+    def hydrate_related(document):
+        instance = hydrate(document)
+        for name, cache_name, related_model in foreign_keys:
+            embedded = document.get(name)
+            if not isinstance(embedded, dict):
+                continue
+            try:
+                hydrate_embedded = hydrators[related_model]
+            except KeyError:
+                # Embedded documents carry their own foreign keys while the
+                # mapping depth allows, so attach whatever is there
+                hydrate_embedded = hydrators[related_model] = get_hydrator(
+                    related_model, using, _foreign_key_names(related_model))
+            instance.__dict__[cache_name] = hydrate_embedded(embedded)
+        return instance
+
+    return hydrate_related
+
+
+def _get_hydrator(model, using, pk_attname, fields):
+    if signals.pre_init.has_listeners(model) or signals.post_init.has_listeners(model):
+        embedded_names = _foreign_key_names(model)
+
+        def construct(document):
+            data = dict_keys_to_str(document)
+            for name in embedded_names:
+                if isinstance(data.get(name), dict):
+                    del data[name]
+            for attname, get_default, to_python in fields:
+                if to_python and attname in data:
+                    data[attname] = to_python(data[attname])
+            instance = model(**data)
+            instance._state.adding = False
+            instance._state.db = using
+            return instance
+
+        return construct
+
+    new = model.__new__
+
+    def hydrate(document):
+        if '_id' in document:
+            document[pk_attname] = document.pop('_id')
+        instance = new(model)
+        values = instance.__dict__
+        for attname, get_default, to_python in fields:
+            try:
+                value = document[attname]
+            except KeyError:
+                values[attname] = get_default()
+                continue
+            values[attname] = to_python(value) if to_python else value
+        state = values['_state'] = ModelState(using)
+        state.adding = False
+        return instance
+
+    return hydrate
+
+
 class ModelLazyObject(SimpleLazyObject):
     """
     A lazy object initialised a model.
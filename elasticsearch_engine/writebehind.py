@@ -0,0 +1,255 @@
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.db.utils import DatabaseError
+
+from .bulk import BULK_CHUNK_SIZE, _unsent_failures, encode_action, send_bulk
+
+__doc__ = "Writes queued in process and sent to elasticsearch by background workers"
+
+logger = logging.getLogger(__name__)
+
+# Documents waiting to be sent before put() blocks or rejects writes
+WRITE_BEHIND_MAX_SIZE = 10000
+
+# Threads sending _bulk requests
+WRITE_BEHIND_WORKERS = 2
+
+# Seconds a worker waits for more writes before sending a batch that is
+# not full
+WRITE_BEHIND_LINGER = 0.05
+
+# alias -> WriteBehindIndexer, shared by the threads of the process
+_INDEXERS = {}
+_INDEXERS_LOCK = threading.Lock()
+
+
+class WriteBehindFull(DatabaseError):
+    """The write-behind queue is full and the write was not queued."""
+
+
+def _key(header):
+    (op, metadata), = header.items()
+    if metadata.get("_id") is None:
+        # Documents elasticsearch names itself are never coalesced
+        return object()
+    return metadata["_index"], metadata["_type"], metadata["_id"]
+
+
+def _source(encoded):
+    """The decoded source of encoded action lines."""
+    return json.loads(encoded.split("\n", 1)[1])
+
+
+def _with_source(encoded, source):
+    """Encoded action lines with the header of ``encoded`` and ``source``."""
+    return encoded.split("\n", 1)[0] + "\n" + json.dumps(source, separators=(',', ':')) + "\n"
+
+
+def _coalesce(pending, header, encoded):
+    """
+    The header and encoded lines of the single action with the effect of
+    ``pending``, a (header, encoded) pair, followed by ``header``/``encoded``.
+    """
+    if header.keys() != ["update"]:
+        # A new index or delete replaces whatever was pending
+        return header, encoded
+    pending_header, pending_encoded = pending
+    if pending_header.keys() == ["index"]:
+        document = _source(pending_encoded)
+        document.update(_source(encoded)["doc"])
+        return pending_header, _with_source(pending_encoded, document)
+    if pending_header.keys() == ["update"]:
+        fields = _source(pending_encoded)["doc"]
+        fields.update(_source(encoded)["doc"])
+        return pending_header, _with_source(pending_encoded, {"doc": fields})
+    # Updating a document deleted first would fail anyway: keep the delete
+    return pending
+
+
+class WriteBehindIndexer(object):
+    """
+    Index, update and delete actions queued in process and sent through
+    _bulk by background workers, so writers do not wait for elasticsearch.
+
+    Writes to a document still waiting are coalesced into one action.
+    Once ``max_size`` documents wait, put() blocks, up to ``timeout``
+    seconds, or with ``block=False`` rejects the write, raising
+    WriteBehindFull either way. A document is never sent by two workers
+    at once, so its writes reach elasticsearch in order. Failed actions
+    are passed to ``on_failure``, logged by default. Searches only see
+    the writes once they are sent and the index refreshed.
+    """
+
+    def __init__(self, es, max_size=WRITE_BEHIND_MAX_SIZE, workers=WRITE_BEHIND_WORKERS,
+                 batch_size=BULK_CHUNK_SIZE, block=True, timeout=None, linger=WRITE_BEHIND_LINGER,
+                 on_failure=None):
+        self.es = es
+        self.max_size = max_size
+        self.workers = workers
+        self.batch_size = batch_size
+        self.block = block
+        self.timeout = timeout
+        self.linger = linger
+        self.on_failure = on_failure or self._log_failures
+        # key -> [header, encoded lines, time first queued]
+        self._pending = OrderedDict()
+        # key -> time first queued, of the actions being sent
+        self._in_flight = {}
+        self._mutex = threading.Lock()
+        self._work = threading.Condition(self._mutex)
+        self._space = threading.Condition(self._mutex)
+        self._idle = threading.Condition(self._mutex)
+        self._threads = []
+        self._closed = False
+        self.counters = {"queued": 0, "coalesced": 0, "rejected": 0, "sent": 0, "failed": 0}
+
+    def put(self, action):
+        """
+        Queue an action built by bulk.py. It is encoded now, so later
+        changes to its document are not sent, and a document that can't
+        be encoded raises here.
+        """
+        header = action[0]
+        encoded = encode_action(action)
+        key = _key(header)
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self._mutex:
+            while True:
+                if self._closed:
+                    raise DatabaseError("The write-behind indexer is closed")
+                entry = self._pending.get(key)
+                if entry is not None:
+                    entry[:2] = _coalesce(entry[:2], header, encoded)
+                    self.counters["coalesced"] += 1
+                    return
+                if len(self._pending) < self.max_size:
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if not self.block or (remaining is not None and remaining <= 0):
+                    self.counters["rejected"] += 1
+                    raise WriteBehindFull("%d writes are waiting to be sent" % len(self._pending))
+                self._space.wait(remaining)
+            self._pending[key] = [header, encoded, time.time()]
+            self.counters["queued"] += 1
+            self._start()
+            self._work.notify()
+
+    def _start(self):
+        if not self._threads:
+            for number in xrange(self.workers):
+                thread = threading.Thread(target=self._run, name="es-write-behind-%d" % number)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _sendable(self):
+        return [key for key in self._pending if key not in self._in_flight]
+
+    def _take(self):
+        """Wait for sendable writes and move a batch of them in flight; None once closed and empty."""
+        with self._mutex:
+            while not self._sendable():
+                if self._closed and not self._pending:
+                    return None
+                self._work.wait()
+            if len(self._pending) < self.batch_size and not self._closed and self.linger:
+                self._work.wait(self.linger)
+            batch = []
+            for key in self._sendable()[:self.batch_size]:
+                header, encoded, queued = self._pending.pop(key)
+                self._in_flight[key] = queued
+                batch.append((key, encoded))
+            self._space.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            if not batch:
+                # Taken by another worker while this one lingered
+                continue
+            encoded = [lines for key, lines in batch]
+            try:
+                failures = send_bulk(self.es, encoded)
+            except Exception, e:
+                logger.exception("Sending %d queued writes failed", len(batch))
+                failures = _unsent_failures(encoded, e)
+            with self._mutex:
+                for key, lines in batch:
+                    del self._in_flight[key]
+                self.counters["sent"] += len(batch) - len(failures)
+                self.counters["failed"] += len(failures)
+                # Writes to these documents queued meanwhile can be sent now
+                self._work.notify_all()
+                if not self._pending and not self._in_flight:
+                    self._idle.notify_all()
+            if failures:
+                try:
+                    self.on_failure(failures)
+                except Exception:
+                    logger.exception("on_failure of the write-behind indexer failed")
+
+    def _log_failures(self, failures):
+        for failure in failures:
+            logger.error("Queued %s of %s failed: %s", failure["action"], failure["_id"], failure["error"])
+
+    def flush(self, timeout=None):
+        """Wait until every write queued so far is sent. Returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._mutex:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Send the queued writes and stop the workers; later writes are refused."""
+        with self._mutex:
+            self._closed = True
+            self._work.notify_all()
+            self._space.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        """
+        Queue depth and lag: ``depth`` documents are waiting, ``in_flight``
+        being sent, and the oldest unsent write was made ``lag`` seconds ago.
+        """
+        with self._mutex:
+            times = [queued for header, encoded, queued in self._pending.values()[:1]] + self._in_flight.values()
+            stats = dict(self.counters)
+            stats.update(depth=len(self._pending), in_flight=len(self._in_flight),
+                         lag=time.time() - min(times) if times else 0.0)
+        return stats
+
+
+def get_indexer(connection):
+    """
+    The write-behind indexer of ``connection``'s database, None unless its
+    OPTIONS enable WRITE_BEHIND, True or WriteBehindIndexer arguments::
+
+        'OPTIONS': {'WRITE_BEHIND': {'max_size': 50000, 'block': False}}
+    """
+    options = connection.settings_dict.get('OPTIONS', {}).get('WRITE_BEHIND')
+    if not options:
+        return None
+    try:
+        return _INDEXERS[connection.alias]
+    except KeyError:
+        pass
+    with _INDEXERS_LOCK:
+        if connection.alias not in _INDEXERS:
+            indexer = WriteBehindIndexer(connection.db_connection, **(options if isinstance(options, dict) else {}))
+            atexit.register(indexer.close)
+            _INDEXERS[connection.alias] = indexer
+        return _INDEXERS[connection.alias]